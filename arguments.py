@@ -5,16 +5,42 @@ from consts import activation_func,dtypes,norm_layer,unettype,optim
 import os
 from datetime import datetime as dt
 
-def arguments():
+def arguments(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--root', '-R', default='data', help='Directory containing trainA, trainB, testA, testB')
     parser.add_argument('--batch_size', '-b', type=int, default=1)
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='accumulate gradients over this number of mini-batches before each update (the effective batch size is accum_steps * batch_size)')
     parser.add_argument('--gpu', '-g', type=int, nargs="*", default=[0],
-                        help='GPU IDs (currently, only single-GPU usage is supported')
+                        help='GPU IDs (currently, only single-GPU usage is supported); -1 for CPU')
+    parser.add_argument('--cpu_threads', type=int, default=0,
+                        help='number of BLAS/OpenMP threads in CPU mode (0: library default)')
+    parser.add_argument('--mpi', action='store_true',
+                        help='data-parallel training with ChainerMN: launch by mpiexec -n <workers> python train.py --mpi')
     parser.add_argument('--out', '-o', default='result',
                         help='Directory to output the result')
     parser.add_argument('--argfile', '-a', help="specify args file to load settings from")
     parser.add_argument('--imgtype', '-it', default="dcm", help="image file type (file extension)")
+    parser.add_argument('--inmem', action='store_true',
+                        help='decode images once and keep them in memory (non-DICOM images)')
+    parser.add_argument('--inmem_budget_mb', type=int, default=8192,
+                        help='memory budget in MB for images kept in memory with --inmem')
+    parser.add_argument('--shards', action='store_true',
+                        help='read images from shards packed by pack_shards.py')
+    parser.add_argument('--iterator', default='thread', choices=['serial','thread','process'],
+                        help='data loading backend: process workers return examples through shared memory')
+    parser.add_argument('--loader_workers', type=int, default=3,
+                        help='number of threads or processes for data loading')
+    parser.add_argument('--loader_prefetch', type=int, default=1,
+                        help='number of batches prefetched by process workers')
+    parser.add_argument('--batch_prefetch', type=int, default=0,
+                        help='number of A/B batch pairs converted in background during the update step (0: off)')
+    parser.add_argument('--profile', action='store_true',
+                        help='report the time of each phase of the training step (time/*) and write Chrome trace files under <out>/trace')
+    parser.add_argument('--profile_interval', type=int, default=1000,
+                        help='write a trace of the phases in the last this number of iterations')
+    parser.add_argument('--decode_short_side', type=int, default=0,
+                        help='downscale images larger than this short side while decoding (JPEG is decoded at a reduced resolution)')
 
     parser.add_argument('--learning_rate', '-lr', type=float, default=None,
                         help='Learning rate')
@@ -59,8 +85,13 @@ def arguments():
     parser.add_argument('--output_analysis', '-oa', action='store_true',
                         help='Output analysis images in conversion')
 
+    # options for pack_shards.py
+    parser.add_argument('--shard_mb', type=int, default=512,
+                        help='size of each shard file in MB')
+
     # data augmentation
     parser.add_argument('--random_translate', '-rt', type=int, default=4, help='jitter input images by random translation')
+    parser.add_argument('--batch_augment', action='store_true', help='crop, flip, and normalise whole minibatches at once in the batch converter instead of per sample in the loader (faster with --inmem or DICOM datasets and the serial or thread iterator)')
     parser.add_argument('--noise', '-n', type=float, default=0,
                         help='strength of noise injection')
     parser.add_argument('--noise_z', '-nz', type=float, default=0,
@@ -75,6 +106,18 @@ def arguments():
     parser.add_argument('--forceSpacing', '-fs', type=float, default=-1,   # 0.7634, 
                             help='scale dicom to match the specified spacing')
     parser.add_argument('--num_slices', '-ns', type=int, default=1, help='number of slices stacked together')
+    parser.add_argument('--cache_dir', '-cd', default=None,
+                        help='directory to cache preprocessed volumes (rebuilt automatically when the source files or parameters change)')
+    parser.add_argument('--manifest', action='store_true',
+                        help='keep a manifest of files under each dataset directory (in cache_dir, or in the directory itself) so that only new or modified directories are rescanned')
+    parser.add_argument('--load_workers', '-lw', type=int, default=1,
+                        help='number of worker processes for reading DICOM series')
+    parser.add_argument('--load_slice_parallel', action='store_true',
+                        help='decode slices of each series in parallel instead of distributing whole series to workers')
+    parser.add_argument('--stream', action='store_true',
+                        help='load volumes on demand instead of keeping all of them in memory')
+    parser.add_argument('--volume_cache_mb', type=int, default=4096,
+                        help='memory budget in MB per process for volumes kept in memory with --stream (shared by the training and test datasets)')
 
     # discriminator
     parser.add_argument('--dis_activation', '-da', default='lrelu', choices=activation_func.keys())
@@ -97,6 +140,8 @@ def arguments():
                         help='dropout ratio for discriminator')
     parser.add_argument('--dis_norm', '-dn', default='instance',
                         choices=norm_layer)
+    parser.add_argument('--dis_separate_passes', action='store_true',
+                        help='run the discriminators separately on real and fake samples instead of on their concatenation (always so with batch normalisation)')
     parser.add_argument('--dis_reg_weighting', '-dw', type=float, default=0,
                         help='regularisation of weighted discriminator. Set 0 to disable weighting')
     parser.add_argument('--dis_wgan', '-wgan', action='store_true',help='WGAN-GP')
@@ -137,6 +182,10 @@ def arguments():
 
     parser.add_argument('--single_encoder', '-senc', action='store_true',
                         help='use the same encoder enc_x = enc_y for both domains')
+    parser.add_argument('--gen_recompute', default='none', choices=['none','resblock','cbr','all'],
+                        help='recompute activations of these stages of the generators during backward instead of storing them (saves memory at the cost of extra computation)')
+    parser.add_argument('--gen_separate_passes', action='store_true',
+                        help='run the generators separately on each input instead of on the inputs concatenated along the batch axis (always so with batch normalisation)')
 
     ## loss function
     parser.add_argument('--lambda_A', '-lcA', type=float, default=10.0,
@@ -169,6 +218,10 @@ def arguments():
                         help='lambda for the total variation')
     parser.add_argument('--lambda_wgan_gp', '-lwgp', type=float, default=10,
                         help='lambda for the gradient penalty for WGAN')
+    parser.add_argument('--gp_type', default='wgan', choices=['wgan','r1'],
+                        help='gradient penalty for WGAN: wgan (at interpolations of real and fake samples) or r1 (at real samples, reusing their forward pass for the loss)')
+    parser.add_argument('--gp_interval', type=int, default=1,
+                        help='compute the gradient penalty every this number of iterations (with the weight multiplied by it)')
     parser.add_argument('--lambda_reg', '-lreg', type=float, default=0,
                         help='weight for regularisation for encoders')
     parser.add_argument('--lambda_dis_z', '-lz', type=float, default=0,
@@ -191,7 +244,7 @@ def arguments():
     parser.add_argument('--HU_range_vis', '-hurv', type=int, default=0, help='the maximum HU value to be visualised will be HU_base+HU_range')
 
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.epoch:
         args.lrdecay_period = args.epoch//2
         args.lrdecay_start = args.epoch - args.lrdecay_period
@@ -210,5 +263,8 @@ def arguments():
             args.crop_height = 280  ## default for the CBCT dataset
         if not args.crop_width:
             args.crop_width = 368  ## default for the CBCT dataset
+    if args.stream and args.iterator == 'process':
+        # every worker process would keep its own cache and decode the volumes of the whole group
+        parser.error("--stream cannot be used with --iterator process: use --iterator thread")
     args.out = os.path.join(args.out, dt.now().strftime('%m%d_%H%M'))
     return(args)
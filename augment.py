@@ -0,0 +1,90 @@
+import random
+import numpy as np
+import chainer
+
+## fused augmentation: the crop window and the flip are decided first,
+## and the normalised sample is written by a single pass into a newly allocated output
+
+def center_offsets(h, w, H, W):
+    ## offsets of the window which edge padding and center_crop to (H,W) would select
+    p = max(H-h, W-w, 0)
+    return -p + int(round((h+2*p-H)/2.)), -p + int(round((w+2*p-W)/2.))
+
+def crop_offsets(h, w, H, W, r):
+    ## offsets of the window which edge padding, center_crop to (H+2r,W+2r), and random_crop to (H,W) would select
+    top, left = center_offsets(h, w, H+2*r, W+2*r)
+    return top + random.randint(0,2*r), left + random.randint(0,2*r)
+
+def clamp_offsets(h, w, top, left, H, W):
+    ## a window lying entirely outside the image consists of copies of the nearest edge,
+    ## so it is moved until it overlaps the image by one row (column), which gives the same pixels
+    return min(max(top,1-H),h-1), min(max(left,1-W),w-1)
+
+def window(img, top, left, H, W):
+    ## img[:, top:top+H, left:left+W] as stored, where out-of-bounds pixels are filled by edge padding
+    _, h, w = img.shape
+    top, left = clamp_offsets(h, w, top, left, H, W)
+    y0, y1 = max(top,0), min(top+H,h)
+    x0, x1 = max(left,0), min(left+W,w)
+    img = np.asarray(img[:, y0:y1, x0:x1])
+    if (y0,y1,x0,x1) != (top,top+H,left,left+W):
+        img = np.pad(img,((0,0),(y0-top,top+H-y1),(x0-left,left+W-x1)),'edge')
+    return img
+
+def augment(img, top, left, H, W, base, rang, flip=False, dtype=np.float32):
+    ## 2*(clip(img,base,base+rang)-base)/rang-1 of the window img[:, top:top+H, left:left+W],
+    ## where out-of-bounds pixels are filled by edge padding, and flipped horizontally if flip
+    _, h, w = img.shape
+    top, left = clamp_offsets(h, w, top, left, H, W)
+    y0, y1 = max(top,0), min(top+H,h)
+    x0, x1 = max(left,0), min(left+W,w)
+    out = np.empty((img.shape[0],H,W), dtype=np.float32)  # numpy has no fast float16 arithmetic
+    o = out[:,:,::-1] if flip else out   # writing through a reversed view flips without another copy
+    dst = o[:, y0-top:y1-top, x0-left:x1-left]
+    src = img[:, y0:y1, x0:x1]
+    np.multiply(src, 2/rang, out=dst, dtype=np.float32, casting='unsafe')
+    dst -= 2*base/rang+1.0
+    # clipping is needed only when the source type can hold values out of the range
+    if src.dtype.kind not in 'ui' or base > np.iinfo(src.dtype).min or base+rang < np.iinfo(src.dtype).max:
+        np.maximum(dst, -1.0, out=dst)
+        np.minimum(dst, 1.0, out=dst)
+    # edge padding
+    if y0 > top:
+        o[:, :y0-top, x0-left:x1-left] = dst[:, :1]
+    if y1 < top+H:
+        o[:, y1-top:, x0-left:x1-left] = dst[:, -1:]
+    if x0 > left:
+        o[:, :, :x0-left] = o[:, :, x0-left:x0-left+1]
+    if x1 < left+W:
+        o[:, :, x1-left:] = o[:, :, x1-left-1:x1-left]
+    return out if dtype == np.float32 else out.astype(dtype)
+
+## converter which crops, flips, and normalises a whole minibatch at once
+## the dataset returns raw windows of size crop+2*random (see batch_augment of the datasets)
+class BatchAugment():
+    def __init__(self, dataset):
+        self.crop = dataset.crop
+        self.random = dataset.random
+        self.flip = dataset.flip
+        self.base, self.range = dataset.norm_range()
+        self.dtype = dataset.dtype
+
+    def __call__(self, batch, device=None):
+        n = len(batch)
+        c, h, w = batch[0].shape
+        H, W = self.crop
+        dy = np.random.randint(0, h-H+1, n)
+        dx = np.random.randint(0, w-W+1, n)
+        flip = np.random.rand(n) < 0.5 if self.flip else np.zeros(n, dtype=bool)
+        # the crops are gathered in the source type, which is usually smaller than the output
+        img = np.empty((n,c,H,W), dtype=batch[0].dtype)
+        for i,raw in enumerate(batch):
+            crop = raw[:, dy[i]:dy[i]+H, dx[i]:dx[i]+W]
+            img[i] = crop[:, :, ::-1] if flip[i] else crop
+        # normalisation of the whole batch (clipping is needed only when the source type can hold values out of the range)
+        out = np.multiply(img, 2/self.range, dtype=np.float32)
+        out -= 2*self.base/self.range+1.0
+        if img.dtype.kind not in 'ui' or self.base > np.iinfo(img.dtype).min or self.base+self.range < np.iinfo(img.dtype).max:
+            np.maximum(out, -1.0, out=out)
+            np.minimum(out, 1.0, out=out)
+        return chainer.dataset.to_device(device, out.astype(self.dtype, copy=False))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#############################
+##
+## Microbenchmarks
+## python benchmark.py augment -it jpg -cw 256 -ch 256 -rt 4 --bench_size 1024
+## python benchmark.py loader -R data -it jpg -cw 256 -ch 256 -b 8 --loader_workers 4
+## python benchmark.py sn -g -1 -b 4
+## python benchmark.py step -g -1 -cw 128 -ch 128 -b 2 --bench_iters 10
+## python benchmark.py recompute -g -1 -cw 256 -ch 256 -u concat --bench_iters 3
+## (options other than --bench_* are those of train.py)
+##
+#############################
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import copy
+import time
+import tracemalloc
+import random
+import argparse
+import numpy as np
+
+from chainercv.transforms import random_crop,center_crop,random_flip
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer.dataset import convert
+
+from arguments import arguments
+from loader import make_iterator
+from sn import SNConvolution2D
+from consts import dtypes, optim
+from net import Encoder, Decoder, Discriminator
+from updater import Updater
+from augment import center_offsets, crop_offsets, window, augment, BatchAugment
+
+def timeit(f, n):
+    f()  # warm up
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter()-start)/n
+
+## per-sample cost of cropping, flipping, and normalising an image
+def bench_augment(args, bargs):
+    ch = 1 if args.grey else 3
+    img = np.random.randint(0, 256, (ch, bargs.bench_size, bargs.bench_size)).astype(np.uint8)
+    H, W = args.crop_height or 256, args.crop_width or 256
+    r = args.random_translate
+    dtype = dtypes[args.dtype]
+    def separate():
+        x = img
+        if x.shape[1]<H+2*r or x.shape[2] < W+2*r:
+            p = max(H+2*r-x.shape[1],W+2*r-x.shape[2])
+            x = np.pad(x,((0,0),(p,p),(p,p)),'edge')
+        x = random_crop(center_crop(x, (H+2*r,W+2*r)),(H,W))
+        if r:
+            x = random_flip(x, x_random=True)
+        return (x.astype(np.float32)/127.5-1.0).astype(dtype)
+    def fused():
+        top, left = crop_offsets(img.shape[1], img.shape[2], H, W, r)
+        flip = bool(r) and random.choice([True, False])
+        return augment(img, top, left, H, W, 0, 255, flip=flip, dtype=dtype)
+    # --batch_augment: windows of size crop+2r are cut per sample and the rest is done per minibatch
+    raw = argparse.Namespace(crop=(H,W), random=r, flip=True, dtype=dtype, norm_range=lambda: (0,255))
+    top, left = center_offsets(img.shape[1], img.shape[2], H+2*r, W+2*r)
+    converter = BatchAugment(raw)
+    def batched():
+        return converter([window(img, top, left, H+2*r, W+2*r) for _ in range(args.batch_size)])
+    print("image {}, crop {}, random translation {}, dtype {}, batch size {}".format(img.shape, (H,W), r, args.dtype, args.batch_size))
+    for name,f,n in [('separate',separate,1),('fused',fused,1),('batched',batched,args.batch_size)]:
+        t = timeit(f, bargs.bench_iters)/n
+        print("{:>10}: {:.3f} ms/sample".format(name, 1000*t))
+
+## samples per second of data loading (including batch conversion on CPU) for each iterator backend
+def bench_loader(args, bargs):
+    if args.imgtype=="dcm":
+        if args.stream:
+            from dataset_dicom import DatasetStream as Dataset
+        else:
+            from dataset_dicom import Dataset as Dataset
+    elif args.shards:
+        from dataset_jpg import DatasetShard as Dataset
+    elif args.inmem:
+        from dataset_jpg import DatasetInMem as Dataset
+    else:
+        from dataset_jpg import DatasetOutMem as Dataset
+    dataset = Dataset(path=os.path.join(args.root, 'trainA'), args=args, base=args.HU_baseA, rang=args.HU_rangeA, random=args.random_translate)
+    converter = BatchAugment(dataset) if dataset.batch_augment else convert.concat_examples
+    for backend in bargs.bench_backends:
+        if args.stream and backend == 'process':   # not supported (see arguments.py)
+            continue
+        args.iterator = backend
+        iterator = make_iterator(dataset, args.batch_size, args)
+        converter(iterator.next())  # warm up (and measure shared memory for process workers)
+        start = time.perf_counter()
+        for _ in range(bargs.bench_iters):
+            converter(iterator.next())
+        t = time.perf_counter()-start
+        iterator.finalize()
+        print("{:>8} ({} workers): {:.1f} samples/sec".format(backend, args.loader_workers, bargs.bench_iters*args.batch_size/t))
+
+## per-step time of a stack of spectrally normalised convolutions (used in NonLocalBlock of --dis_attention)
+## with three forward passes per step as in the discriminator update (real, fake, and through the generator loss)
+def bench_sn(args, bargs):
+    ch, size, depth = 512, bargs.bench_size//64, 4
+    x = np.random.randn(args.batch_size, ch, size, size).astype(np.float32)
+    def step(model, opt):
+        model.cleargrads()
+        loss = sum([F.sum(model(x)) for _ in range(3)])
+        loss.backward()
+        opt.update()
+    print("{} 1x1 convolutions with {} channels, input {}".format(depth, ch, x.shape))
+    for name,layer,cache in [('plain',L.Convolution2D,False),('sn',SNConvolution2D,False),('sn cached',SNConvolution2D,True)]:
+        SNConvolution2D.cache_W_bar = cache
+        model = chainer.Sequential(*[layer(ch, ch, 1, 1, 0) for _ in range(depth)])
+        if args.gpu[0] >= 0:
+            model.to_gpu()
+            x = chainer.cuda.to_gpu(x)
+        opt = chainer.optimizers.Adam()
+        opt.setup(model)
+        t = timeit(lambda: step(model, opt), bargs.bench_iters)
+        print("{:>10}: {:.3f} ms/step".format(name, 1000*t))
+    SNConvolution2D.cache_W_bar = True
+
+## a training updater on synthetic data
+def make_updater(args):
+    args.ch = args.out_ch = 1 if args.grey else 3
+    enc_x = Encoder(args)
+    enc_y = enc_x if args.single_encoder else Encoder(args)
+    models = (enc_x, Decoder(args), enc_y, Decoder(args), Discriminator(args), Discriminator(args),
+              Discriminator(args) if args.lambda_dis_z>0 else L.Linear(1,1))
+    optimizers = {}
+    for name,model in zip(['opt_enc_x','opt_dec_x','opt_enc_y','opt_dec_y','opt_x','opt_y','opt_z'], models):
+        if args.gpu[0] >= 0:
+            model.to_gpu()
+        optimizers[name] = optim[args.optimizer](args.learning_rate_g)
+        optimizers[name].setup(model)
+    data = [np.random.uniform(-1, 1, (args.ch, args.crop_height, args.crop_width)).astype(np.float32) for _ in range(4*args.batch_size)]
+    iterator = {'main': chainer.iterators.SerialIterator(data, args.batch_size), 'train_B': chainer.iterators.SerialIterator(data, args.batch_size)}
+    updater = Updater(models=models, iterator=iterator, optimizer=optimizers, converter=convert.concat_examples, device=args.gpu[0], params={'args': args})
+    reporter = chainer.Reporter()
+    for name,model in zip(optimizers, models):
+        reporter.add_observer(name, model)
+    return updater, reporter
+
+## per-step time of the training updater (LSGAN and WGAN-GP) with and without concatenated passes of the discriminators,
+## and with the lazy (every 4 steps) and R1 gradient penalties
+def bench_step(args, bargs):
+    args.crop_height, args.crop_width = args.crop_height or 128, args.crop_width or 128
+    variants = [('lsgan', {'dis_wgan': False, 'dis_separate_passes': True}), ('lsgan fused', {'dis_wgan': False}),
+                ('wgan', {'dis_wgan': True, 'dis_separate_passes': True}), ('wgan fused', {'dis_wgan': True}),
+                ('wgan gp/4', {'dis_wgan': True, 'gp_interval': 4}), ('wgan r1', {'dis_wgan': True, 'gp_type': 'r1'})]
+    print("crop {}, batch size {}, generator channels {}, discriminator channels {}".format((args.crop_height,args.crop_width), args.batch_size, args.gen_chs, args.dis_chs))
+    for name,opts in variants:
+        vargs = copy.copy(args)
+        vargs.__dict__.update(opts)
+        updater, reporter = make_updater(vargs)
+        with reporter.scope({}):
+            t = timeit(updater.update, bargs.bench_iters)
+        print("{:>12}: {:.1f} ms/step".format(name, 1000*t))
+
+## peak memory and time per training step for each setting of --gen_recompute
+## (peak of numpy allocations traced by tracemalloc on CPU, and bytes held by the memory pool of cupy on GPU)
+def bench_recompute(args, bargs):
+    args.crop_height, args.crop_width = args.crop_height or 256, args.crop_width or 256
+    print("crop {}, batch size {}, generator channels {}, u-net {}".format((args.crop_height,args.crop_width), args.batch_size, args.gen_chs, args.unet))
+    for mode in ['none','resblock','cbr','all']:
+        vargs = copy.copy(args)
+        vargs.gen_recompute = mode
+        updater, reporter = make_updater(vargs)
+        with reporter.scope({}):
+            t = timeit(updater.update, bargs.bench_iters)
+            if args.gpu[0] >= 0:
+                import cupy
+                pool = cupy.get_default_memory_pool()
+                pool.free_all_blocks()
+                updater.update()
+                peak = pool.total_bytes()
+            else:
+                tracemalloc.start()
+                updater.update()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        print("{:>10}: {:.1f} ms/step, peak memory {:.1f} MB".format(mode, 1000*t, peak/2**20))
+        del updater
+
+benchmarks = {'augment': bench_augment, 'loader': bench_loader, 'sn': bench_sn, 'step': bench_step, 'recompute': bench_recompute}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=benchmarks.keys())
+    parser.add_argument('--bench_iters', type=int, default=200, help='number of repetitions')
+    parser.add_argument('--bench_size', type=int, default=1024, help='side of synthetic images')
+    parser.add_argument('--bench_backends', nargs="*", default=['serial','thread','process'], help='iterator backends to be compared')
+    bargs, rest = parser.parse_known_args()
+    args = arguments(rest)
+    benchmarks[bargs.benchmark](args, bargs)
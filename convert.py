@@ -24,6 +24,7 @@ from chainercv.utils import write_image
 from chainercv.transforms import resize
 from chainerui.utils import save_args
 from arguments import arguments 
+from loader import make_iterator
 from consts import dtypes
 from chainer.links import VGG16Layers
 
@@ -79,8 +80,15 @@ if __name__ == '__main__':
 
     ## load images
     if args.imgtype=="dcm":
-        from dataset_dicom import Dataset as Dataset
+        if args.stream:
+            from dataset_dicom import DatasetStream as Dataset
+        else:
+            from dataset_dicom import Dataset as Dataset
         args.grey = True
+    elif args.shards:
+        from dataset_jpg import DatasetShard as Dataset
+    elif args.inmem:
+        from dataset_jpg import DatasetInMem as Dataset
     else:
         from dataset_jpg import DatasetOutMem as Dataset   
 
@@ -91,7 +99,7 @@ if __name__ == '__main__':
     dataset = Dataset(path=args.root, args=args, base=args.HU_baseA, rang=args.HU_rangeA, random=0)
     args.ch = dataset.ch
 #    iterator = chainer.iterators.MultiprocessIterator(dataset, args.batch_size, n_processes=3, repeat=False, shuffle=False)
-    iterator = chainer.iterators.MultithreadIterator(dataset, args.batch_size, n_threads=3, repeat=False, shuffle=False)   ## best performance
+    iterator = make_iterator(dataset, args.batch_size, args, repeat=False, shuffle=False)
 #    iterator = chainer.iterators.SerialIterator(dataset, args.batch_size,repeat=False, shuffle=False)
 
     ## load generator models
@@ -126,7 +134,8 @@ if __name__ == '__main__':
     ## prepare networks for analysis 
     if args.output_analysis:
         vgg = VGG16Layers()  # for perceptual loss
-        vgg.to_gpu()
+        if args.gpu >= 0:
+            vgg.to_gpu()
         if is_AE:
             enc_i = net.Encoder(args)
             dec_i = net.Decoder(args)
@@ -2,14 +2,156 @@ import os
 import pydicom as dicom
 import random
 import glob
+import hashlib
+import contextlib
+import functools
+import collections
+import threading
+import itertools
+import time
+import json
 
+from concurrent.futures import ProcessPoolExecutor
+
+import chainer
 from chainer.dataset import dataset_mixin
 import numpy as np
 #from skimage.transform import rescale
-from chainercv.transforms import random_crop,center_crop,resize
+from chainercv.transforms import center_crop,resize
 from consts import dtypes
+from augment import augment
+from manifest import Manifest
+
+## bump this when the format of the cached volumes changes
+CACHE_VERSION = 3
+
+def img2var(img,base,rang):
+    # output clipped and scaled to [-1,1]
+    return(2*(np.clip(img,base,base+rang)-base)/rang-1.0)
+
+def read_z(f):
+    ## header-only read: return the z-coord of the slice, or None if it is not recorded
+    ds = dicom.dcmread(f, stop_before_pixels=True, force=True, specific_tags=['ImagePositionPatient'])
+    if hasattr(ds, 'ImagePositionPatient'): # Thanks to johnrickman for letting me know to use this DICOM entry
+#    if hasattr(ds, 'SliceLocation'):
+        return float(ds.ImagePositionPatient[2])
+    else:
+        return None
+
+def read_slice(f):
+    ## read a DICOM file and return (HU image, pixel spacing)
+    ds = dicom.dcmread(f, force=True)
+    #ds.file_meta.TransferSyntaxUID = dicom.uid.ImplicitVRLittleEndian
+    spacing = float(ds.PixelSpacing[0]) if hasattr(ds, 'PixelSpacing') else None
+    return ds.pixel_array.astype(np.float32)+ds.RescaleIntercept, spacing
+
+def resample(volume, scaling, block=512):
+    ## in-plane bilinear resampling of a volume (z,x,y); cv2 takes at most 512 channels at a time
+    size = (int(scaling*volume.shape[1]),int(scaling*volume.shape[2]))
+    return np.concatenate([resize(volume[k:k+block],size) for k in range(0,len(volume),block)])
+
+def locate_slices(files, slice_range=None, mapper=map, zs=None):
+    ## sort and filter slices by z without reading pixel data (zs can be given if known)
+    if slice_range is None:
+        return sorted(files)  # sort by filename
+    if zs is None:
+        zs = mapper(read_z, files)
+    locs = []
+    for f,z in zip(files,zs):
+        if z is None:
+            locs.append((f,f))  # sort by filename
+        elif slice_range[0] < z < slice_range[1]:
+            locs.append((z,f))  # sort by z-coord
+    return [f for _,f in sorted(locs, key=lambda l: l[0])]
+
+def load_volume(files, base, rang, crop, forceSpacing=-1, slice_range=None, zs=None, pool=None):
+    ## read a series of DICOM files into an int16 HU volume of shape (z,x,y) centre-cropped to crop=(h,w)
+    ## HU values are clipped to [base,base+rang]; scaling to [-1,1] is done per sample by img2var
+    ## when a process pool is given, slices are decoded in parallel
+    mapper = map if pool is None else functools.partial(pool.map, chunksize=4)
+    # first pass: header only
+    filenames = locate_slices(files, slice_range, mapper, zs)
+    if len(filenames)==0:
+        return None, []
+    # second pass: decode only the slices kept
+    slices = list(mapper(read_slice, filenames))
+
+    if forceSpacing>0:
+        # resample runs of slices sharing the same spacing and shape at once
+        start = time.time()
+        vollist = []
+        for (spacing,_),group in itertools.groupby(slices, key=lambda sl: (sl[1],sl[0].shape)):
+            vollist.append(resample(np.stack([sl for sl,_ in group]), forceSpacing/spacing))
+        volume = np.concatenate(vollist)
+        print("Resampled {} slices to {} in {:.3f} sec".format(len(slices),volume.shape[1:],time.time()-start))
+    else:
+        volume = np.stack([sl for sl,_ in slices])
+    volume = np.rint(np.clip(volume,base,base+rang)).astype(np.int16)   # shape = (z,x,y)
+    if volume.shape[1]<crop[0] or volume.shape[2] < crop[1]:
+        p = max(crop[0]-volume.shape[1],crop[1]-volume.shape[2])
+        volume = np.pad(volume,((0,0),(p,p),(p,p)),'edge')
+    volume = center_crop(volume,crop)
+    return volume, filenames
+
+## on-disk cache of preprocessed volumes
+def cache_key(files, *params):
+    # the key changes whenever a file is added, removed, or modified, or a preprocessing parameter changes
+    h = hashlib.sha1()
+    for f in files:
+        st = os.stat(f)
+        h.update("{}:{}:{}\n".format(os.path.abspath(f),st.st_size,st.st_mtime_ns).encode())
+    h.update(repr((CACHE_VERSION,)+params).encode())
+    return h.hexdigest()
+
+## the slices of a volume are recorded by their indices in files, since the paths may be spelled differently in another run
+def load_cache(cache_dir, key, files):
+    fn = os.path.join(cache_dir, key)
+    if not (os.path.exists(fn+'.npy') and os.path.exists(fn+'.json')):
+        return None, []
+    try:
+        with open(fn+'.json') as f:
+            filenames = [files[k] for k in json.load(f)]
+        volume = np.load(fn+'.npy', mmap_mode='r')
+    except (OSError, ValueError, TypeError, IndexError):
+        print("broken cache entry {}: rebuilding".format(fn))
+        return None, []
+    return volume, filenames
+
+def save_cache(cache_dir, key, volume, filenames, files):
+    os.makedirs(cache_dir, exist_ok=True)
+    fn = os.path.join(cache_dir, key)
+    # write to a temporary file first so that an interrupted job never leaves a truncated entry
+    tmp = "{}.{}.tmp".format(fn,os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, np.ascontiguousarray(volume))
+    os.replace(tmp, fn+'.npy')
+    with open(tmp, 'w') as f:
+        index = {name:k for k,name in enumerate(files)}
+        json.dump([index[name] for name in filenames], f)
+    os.replace(tmp, fn+'.json')
+
+def list_series(path, imgtype, manifest=None):
+    ## list (dirname, files) for path and its immediate subdirectories containing files of imgtype
+    if manifest is not None:
+        _, dirlist = manifest.scan(path, imgtype)
+        dirlist = [manifest.root] + dirlist
+    else:
+        dirlist = [path]
+        for f in os.listdir(path):
+            if os.path.isdir(os.path.join(path, f)):
+                dirlist.append(os.path.join(path,f))
+    series = []
+    for dirname in sorted(dirlist):
+        if manifest is not None:
+            files, _ = manifest.scan(dirname, imgtype)
+        else:
+            files = [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname)) if fname.endswith(imgtype)]
+        if len(files)>0:
+            series.append((dirname,files))
+    return series
 
 class Dataset(dataset_mixin.DatasetMixin):
+    flip = False
     def __init__(self, path, args, base, rang, random=0, mask_value=None):
         self.path = path
         self.base = base
@@ -23,58 +165,73 @@ class Dataset(dataset_mixin.DatasetMixin):
         self.names = []
         self.idx = []
         self.crop = (args.crop_height,args.crop_width)
+        self.batch_augment = args.batch_augment and random>0   # leave random crops to the batch converter
+
+        self.slice_range = args.slice_range
+        self.cache_dir = args.cache_dir
+        self.cache_params = (self.base, self.range, self.forceSpacing, self.padded_crop(), args.slice_range)
+        self.manifest = Manifest(path, args.cache_dir, getattr(args, 'manifest_readonly', False)) if args.manifest else None
 
         print("Loading Dataset from: {}".format(path))
-        dirlist = [path]
-        for f in os.listdir(path):
-            if os.path.isdir(os.path.join(path, f)):
-                dirlist.append(os.path.join(path,f))
-        j = 0  # dir index
-        for dirname in sorted(dirlist):
-            files = [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname)) if fname.endswith(args.imgtype)]
-            slices = []
-            filenames = []
-            loc = []
-            for f in files:
-                ds = dicom.dcmread(f, force=True)
-                #ds.file_meta.TransferSyntaxUID = dicom.uid.ImplicitVRLittleEndian
-                # sort slices according to SliceLocation header
-                if hasattr(ds, 'ImagePositionPatient') and (args.slice_range is not None): # Thanks to johnrickman for letting me know to use this DICOM entry
-#                if hasattr(ds, 'SliceLocation'):
-                    z = float(ds.ImagePositionPatient[2])
-                    if (args.slice_range[0] < z < args.slice_range[1]):
-                        slices.append(ds)
-                        filenames.append(f)
-                        loc.append(z)   # sort by z-coord
-                else:
-                    slices.append(ds)
-                    filenames.append(f)
-                    loc.append(f)  # sort by filename
-            s = sorted(range(len(slices)), key=lambda k: loc[k])
+        series = list_series(path, args.imgtype, self.manifest)
+        self.load(series, args)
+        if self.manifest:
+            print("Manifest: {} directories rescanned".format(self.manifest.nscan))
+            self.manifest.save()
+        print("#dir {}, #file {}, #slices {}".format(len(series),len(self.idx),sum([len(fd) for fd in self.names])))
 
+    def padded_crop(self):
+        # volumes are stored centre-cropped with a margin for random translation
+        return (self.crop[0]+2*self.random, self.crop[1]+2*self.random)
+
+    def load(self, series, args):
+        j = 0  # dir index
+        for (dirname,_),(volume,filenames) in zip(series, self.load_series(series, args.load_workers, args.load_slice_parallel)):
             # if the current dir contains at least one slice
-            if len(s)>0:
-                vollist = []
-                for i in s:
-                    sl = slices[i].pixel_array.astype(self.dtype)+slices[i].RescaleIntercept
-                    if self.forceSpacing>0:
-                        scaling = self.forceSpacing/float(slices[i].PixelSpacing[0])
-                        sl = resize(sl[np.newaxis,],(int(scaling*sl.shape[0]),int(scaling*sl.shape[1])))[0]
-#                        volume = rescale(sl,scaling,mode="reflect",preserve_range=True)
-                    vollist.append(sl)
-                volume = self.img2var(np.stack(vollist))   # shape = (z,x,y)
+            if volume is not None:
                 print("Loaded volume {} of size {}".format(dirname,volume.shape))
-                if volume.shape[1]<self.crop[0]+2*self.random or volume.shape[2] < self.crop[1]+2*self.random:
-                    p = max(self.crop[0]+2*self.random-volume.shape[1],self.crop[1]+2*self.random-volume.shape[2])
-                    volume = np.pad(volume,((0,0),(p,p),(p,p)),'edge')
-                volume = center_crop(volume,(self.crop[0]+2*self.random, self.crop[1]+2*self.random))
                 self.dcms.append(volume)
-                self.names.append( [filenames[i] for i in s] )
-                self.idx.extend([(j,k) for k in range((self.ch-1)//2,len(slices)-self.ch//2)])
+                self.names.append(filenames)
+                self.idx.extend([(j,k) for k in range((self.ch-1)//2,len(filenames)-self.ch//2)])
                 j = j + 1
+        print("Memory footprint of volumes: {:.1f} MB".format(sum([v.nbytes for v in self.dcms])/1024**2))
+
+    def load_series(self, series, workers=1, slice_parallel=False):
+        ## load volumes for a list of (dirname, files), either from the cache or by decoding the DICOM files
+        volumes = [(None,[])]*len(series)
+        keys = [None]*len(series)
+        if self.cache_dir:
+            for i,(_,files) in enumerate(series):
+                keys[i] = cache_key(files, *self.cache_params)
+                volumes[i] = load_cache(self.cache_dir, keys[i], files)
+        todo = [i for i in range(len(series)) if volumes[i][0] is None]
+        load = functools.partial(load_volume, base=self.base, rang=self.range, crop=self.padded_crop(),
+                    forceSpacing=self.forceSpacing, slice_range=self.slice_range)
+        with (ProcessPoolExecutor(workers) if workers>1 and len(todo)>0 else contextlib.nullcontext()) as pool:
+            zs = [self.locations(series[i][1], pool) for i in todo]
+            if pool is None:
+                results = (load(series[i][1], zs=z) for i,z in zip(todo,zs))
+            elif slice_parallel:   # decode slices of each series in parallel
+                results = (load(series[i][1], zs=z, pool=pool) for i,z in zip(todo,zs))
+            else:   # decode each series in a separate worker
+                results = [pool.submit(load, series[i][1], zs=z) for i,z in zip(todo,zs)]
+                results = (r.result() for r in results)
+            for i,(volume,filenames) in zip(todo,results):
+                volumes[i] = (volume,filenames)
+                if volume is not None and self.cache_dir:
+                    save_cache(self.cache_dir, keys[i], volume, filenames, series[i][1])
+        return volumes
+
+    def locations(self, files, pool=None):
+        ## z-coords of slices recorded in the manifest (None if they are to be read by load_volume)
+        if self.manifest is None or self.slice_range is None:
+            return None
+        mapper = map if pool is None else functools.partial(pool.map, chunksize=16)
+        return self.manifest.locations(files, read_z, mapper)
+
+    def get_volume(self, j):
+        return self.dcms[j]
 
-        print("#dir {}, #file {}, #slices {}".format(len(dirlist),len(self.idx),sum([len(fd) for fd in filenames])))
-        
     def __len__(self):
         return len(self.idx)
 
@@ -82,9 +239,12 @@ class Dataset(dataset_mixin.DatasetMixin):
         j,k=self.idx[i]
         return self.names[j][k]
 
+    def norm_range(self):
+        return self.base, self.range
+
     def img2var(self,img):
         # output clipped and scaled to [-1,1]
-        return(2*(np.clip(img,self.base,self.base+self.range)-self.base)/self.range-1.0)
+        return(img2var(img,self.base,self.range))
     
     def var2img(self,var):
         # inverse of img2var
@@ -125,5 +285,128 @@ class Dataset(dataset_mixin.DatasetMixin):
 
     def get_example(self, i):
         j,k = self.idx[i]
-        img = self.dcms[j][(k-(self.ch-1)//2):(k+(self.ch+1)//2)]
-        return random_crop(img,self.crop).astype(self.dtype)
+        img = self.get_volume(j)[(k-(self.ch-1)//2):(k+(self.ch+1)//2)]
+        if self.batch_augment:
+            return img
+        top = random.randint(0,img.shape[1]-self.crop[0])
+        left = random.randint(0,img.shape[2]-self.crop[1])
+        return augment(img, top, left, self.crop[0], self.crop[1], self.base, self.range, dtype=self.dtype)
+
+
+## volumes are loaded on demand and only a limited amount of them are kept in memory
+class DatasetStream(Dataset):
+    def __init__(self, path, args, base, rang, random=0, mask_value=None):
+        self.files = []
+        self.nbytes = []
+        self.budget = args.volume_cache_mb * 1024**2
+        self.cache = collections.OrderedDict()   # LRU cache of volumes
+        self.cache_size = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+        super(DatasetStream, self).__init__(path, args, base, rang, random=random, mask_value=mask_value)
+        self.order_sampler = VolumeOrderSampler(self, chunk=args.batch_size)
+
+    def load(self, series, args):
+        ## index slices without decoding pixel data
+        h,w = self.padded_crop()
+        itemsize = np.dtype(np.int16).itemsize
+        with (ProcessPoolExecutor(args.load_workers) if args.load_workers>1 and self.slice_range is not None else contextlib.nullcontext()) as pool:
+            mapper = map if pool is None else functools.partial(pool.map, chunksize=16)
+            j = 0  # dir index
+            for dirname,files in series:
+                filenames = locate_slices(files, self.slice_range, mapper, self.locations(files, pool))
+                if len(filenames)>0:
+                    self.files.append(files)
+                    self.names.append(filenames)
+                    self.nbytes.append(len(filenames)*h*w*itemsize)
+                    self.idx.extend([(j,k) for k in range((self.ch-1)//2,len(filenames)-self.ch//2)])
+                    j = j + 1
+        print("Indexed {} volumes, {:.1f} MB in total".format(len(self.files),sum(self.nbytes)/1024**2))
+
+    def get_volume(self, j):
+        with self.lock:
+            if j in self.cache:
+                self.cache.move_to_end(j)
+                return self.cache[j]
+            # only one thread loads a given volume; others wait for it
+            loading = self.loading.setdefault(j, threading.Lock())
+        with loading:
+            with self.lock:
+                if j in self.cache:
+                    return self.cache[j]
+            volume, _ = self.load_series([(None,self.files[j])])[0]
+            with self.lock:
+                self.cache[j] = volume
+                self.cache_size += volume.nbytes
+                while self.cache_size > self.budget and len(self.cache)>1:
+                    _, v = self.cache.popitem(last=False)
+                    self.cache_size -= v.nbytes
+                self.loading.pop(j, None)
+        return volume
+
+    def __getstate__(self):
+        # locks and cached volumes are not passed to worker processes
+        state = self.__dict__.copy()
+        state['cache'] = collections.OrderedDict()
+        state['cache_size'] = 0
+        state['loading'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+## shuffle volumes, and slices within groups of volumes fitting in the cache, so that consecutive samples reuse cached volumes
+## with indices, the order is that of a subset whose i-th sample is dataset[indices[i]]
+class VolumeOrderSampler(chainer.iterators.OrderSampler):
+    def __init__(self, dataset, chunk=None, random_state=None, indices=None):
+        self.dataset = dataset
+        self.indices = indices
+        # number of consecutive samples taken from the same volume
+        self.chunk = chunk
+        if random_state is None:
+            random_state = np.random.random.__self__
+        self._random = random_state
+
+    def __call__(self, current_order, current_position):
+        d = self.dataset
+        by_volume = collections.defaultdict(list)
+        for i,s in enumerate(range(len(d.idx)) if self.indices is None else self.indices):
+            by_volume[d.idx[s][0]].append(i)
+        volumes = self._random.permutation(list(by_volume.keys()))
+        groups, size = [[]], 0
+        for j in volumes:
+            if size+d.nbytes[j] > d.budget and len(groups[-1])>0:
+                groups.append([])
+                size = 0
+            groups[-1].append(j)
+            size += d.nbytes[j]
+        order = []
+        for group in groups:
+            # samples from a group of volumes are mixed in chunks
+            chunks = []
+            for j in group:
+                s = self._random.permutation(by_volume[j])
+                c = self.chunk or len(s)
+                chunks.extend([s[k:k+c] for k in range(0,len(s),c)])
+            for k in self._random.permutation(len(chunks)):
+                order.extend(chunks[k])
+        return np.asarray(order, dtype=np.int64)
+
+    def scatter(self, rank, size):
+        ## the indices of the samples assigned to a worker of data-parallel training, and the sampler for them
+        ## whole volumes are assigned (largest first, to the worker with the fewest samples) so that each worker reads only its own volumes,
+        ## and the samples are repeated to make all the workers have the same number of them
+        d = self.dataset
+        by_volume = collections.defaultdict(list)
+        for i,(j,_) in enumerate(d.idx):
+            by_volume[j].append(i)
+        if len(by_volume) < size:
+            raise ValueError("{} volumes cannot be scattered over {} workers".format(len(by_volume), size))
+        parts = [[] for _ in range(size)]
+        for j in sorted(by_volume, key=lambda j: (-len(by_volume[j]), j)):
+            min(parts, key=len).extend(by_volume[j])
+        n = max(len(p) for p in parts)
+        indices = [parts[rank][k % len(parts[rank])] for k in range(n)]
+        return indices, VolumeOrderSampler(d, self.chunk, self._random, indices)
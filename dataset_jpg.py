@@ -1,19 +1,46 @@
 import os
 import random
 import glob
+import json
 
 from chainer.dataset import dataset_mixin
 import numpy as np
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
-from chainercv.transforms import random_crop,center_crop,random_flip
 from chainercv.transforms import resize
 from chainercv.utils import read_image
 
 from consts import dtypes
+from augment import center_offsets, crop_offsets, window, augment
+from manifest import Manifest
+
+## bump this when the format of shards written by pack_shards.py changes
+SHARD_VERSION = 1
+
+## decode an image so that its short side becomes short_side (if it is larger)
+## JPEG is decoded by libjpeg at the smallest power-of-two reduction not below the target, and then resized
+def read_image_scaled(fn, short_side, color=True):
+    mode = 'RGB' if color else 'L'
+    with Image.open(fn) as img:
+        scale = short_side / min(img.size)
+        if scale < 1:
+            size = (max(1,int(round(img.size[0]*scale))), max(1,int(round(img.size[1]*scale))))
+            img.draft(mode, size)
+            img = img.convert(mode)
+            if img.size != size:
+                img = img.resize(size, Image.BILINEAR)
+        else:
+            img = img.convert(mode)
+        img = np.asarray(img, dtype=np.uint8)
+    if img.ndim == 2:
+        return img[np.newaxis]
+    else:
+        return img.transpose((2, 0, 1))
 
 ## load images everytime from disk: slower but low memory usage
 class DatasetOutMem(dataset_mixin.DatasetMixin):
+    flip = True  # random horizontal flip
     def __init__(self, path, args, base, rang, random=0):
         self.path = path
         self.names = []
@@ -24,16 +51,32 @@ class DatasetOutMem(dataset_mixin.DatasetMixin):
         self.dtype = dtypes[args.dtype]
         self.base = base # used only with npy files
         self.range = rang
-        for fn in glob.glob(os.path.join(self.path,"**/*.{}".format(self.imgtype)), recursive=True):
-            self.names.append(fn)
+        self.decode_short_side = args.decode_short_side
+        self.batch_augment = args.batch_augment and random>0   # leave random crops and flips to the batch converter
+        self.names = self.list_images(args)
         if args.crop_height and args.crop_width:
             self.crop = (args.crop_height,args.crop_width)
         else:
             self.crop=None
-        self.names = sorted(self.names)
+        if self.batch_augment and not self.crop:
+            raise ValueError("--batch_augment requires --crop_width and --crop_height")
+        if self.crop and self.decode_short_side and self.decode_short_side < min(self.crop)+2*self.random:
+            print("Warning: images decoded with short side {} will be padded to be cropped to {}".format(self.decode_short_side,self.crop))
         print("Cropped to: ",self.crop)
         print("Loaded: {} images from {}".format(len(self.names),path))
 
+    def list_images(self, args):
+        names = []
+        if args.manifest:   # list only new or modified directories
+            manifest = Manifest(self.path, args.cache_dir, getattr(args, 'manifest_readonly', False))
+            names = manifest.walk(".{}".format(self.imgtype))
+            print("Manifest: {} directories rescanned".format(manifest.nscan))
+            manifest.save()
+        else:
+            for fn in glob.glob(os.path.join(self.path,"**/*.{}".format(self.imgtype)), recursive=True):
+                names.append(fn)
+        return sorted(names)
+
     def __len__(self):
         return len(self.names)
 
@@ -46,27 +89,44 @@ class DatasetOutMem(dataset_mixin.DatasetMixin):
     def img2var(self,img):  # [0,255] => [-1,1]
         return(img/127.5 - 1.0)
 
-    def get_example(self, i):
+    def read(self, i):
+        ## raw image: uint8 for images, as stored for npy (memory-mapped)
         if self.imgtype == "npy":
-            img = np.load(self.get_img_path(i))
-            img = 2*(np.clip(img,self.base,self.base+self.range)-self.base)/self.range-1.0
+            img = np.load(self.get_img_path(i), mmap_mode='r')
             if len(img.shape) == 2:
                 img = img[np.newaxis,]
+        elif self.decode_short_side:
+            img = read_image_scaled(self.get_img_path(i),self.decode_short_side,color=self.color)
+        else:
+            img = read_image(self.get_img_path(i),color=self.color,dtype=np.uint8)
+        return img
+
+    def load(self, i):
+        return self.read(i)
+
+    def norm_range(self):
+        # values in [base,base+range] are mapped to [-1,1]
+        if self.imgtype == "npy":
+            return self.base, self.range
         else:
-            img = self.img2var(read_image(self.get_img_path(i),color=self.color))
-        
+            return 0, 255
+
+    def get_example(self, i):
+        img = self.load(i)
+        _, h, w = img.shape
 #        img = resize(img, (self.resize_to, self.resize_to))
         if self.crop:
             H, W = self.crop
         else:
-            H, W = ( 16*((img.shape[1]-2*self.random)//16), 16*((img.shape[2]-2*self.random)//16) )
-        if img.shape[1]<H+2*self.random or img.shape[2] < W+2*self.random:
-            p = max(H+2*self.random-img.shape[1],W+2*self.random-img.shape[2])
-            img = np.pad(img,((0,0),(p,p),(p,p)),'edge')
-        img = random_crop(center_crop(img, (H+2*self.random,W+2*self.random)),(H,W))
-        if self.random:
-            img = random_flip(img, x_random=True)
-        return img.astype(self.dtype)
+            H, W = ( 16*((h-2*self.random)//16), 16*((w-2*self.random)//16) )
+        if self.batch_augment:
+            top, left = center_offsets(h, w, H+2*self.random, W+2*self.random)
+            return window(img, top, left, H+2*self.random, W+2*self.random)
+        top, left = crop_offsets(h, w, H, W, self.random)
+        flip = bool(self.random) and random.choice([True, False])
+        # normalisation is done only for the cropped window
+        base, rang = self.norm_range()
+        return augment(img, top, left, H, W, base, rang, flip=flip, dtype=self.dtype)
 
     def mask(self,fn):
         img = Image.open(fn)
@@ -83,3 +143,51 @@ class DatasetOutMem(dataset_mixin.DatasetMixin):
             img = img.transpose((2, 0, 1))[:3,:,:]
         img = img * mask
         return img2var(img)
+
+
+## decode images once and keep them in memory (images exceeding the memory budget are read from disk every time)
+class DatasetInMem(DatasetOutMem):
+    def __init__(self, path, args, base, rang, random=0):
+        super(DatasetInMem, self).__init__(path, args, base, rang, random=random)
+        budget = args.inmem_budget_mb * 1024**2
+        self.images = [None]*len(self.names)
+        size = 0
+        chunk = 64*max(1,args.load_workers)
+        full = False
+        with ThreadPoolExecutor(max(1,args.load_workers)) as pool:
+            # decode in chunks so that we can stop when the budget is used up
+            for k in range(0,len(self.names),chunk):
+                for i,img in enumerate(pool.map(self.read, range(k,min(k+chunk,len(self.names)))), k):
+                    full = full or size+img.nbytes > budget
+                    if not full:
+                        self.images[i] = np.array(img)  # npy files are read as memory maps
+                        size += img.nbytes
+                if full:
+                    break
+        n = sum([img is not None for img in self.images])
+        print("Decoded {} images into memory: {:.1f} MB, {} images left on disk".format(n,size/1024**2,len(self.names)-n))
+
+    def load(self, i):
+        img = self.images[i]
+        if img is None:
+            img = self.read(i)
+        return img
+
+
+## read images from shards written by pack_shards.py: a sample is a view of a memory-mapped buffer
+class DatasetShard(DatasetOutMem):
+    def list_images(self, args):
+        with open(os.path.join(self.path, 'index.json')) as f:
+            index = json.load(f)
+        if index['version'] != SHARD_VERSION:
+            raise ValueError("shards in {} are of an old format: pack them again".format(self.path))
+        if index['color'] != self.color:
+            raise ValueError("shards in {} were packed with grey={}".format(self.path, not index['color']))
+        self.imgtype = index['imgtype']
+        self.shards = [np.load(os.path.join(self.path, fn), mmap_mode='r') for fn in index['shards']]
+        self.index = [(s,offset,tuple(shape)) for _,s,offset,shape in index['images']]
+        return [name for name,_,_,_ in index['images']]
+
+    def load(self, i):
+        s,offset,shape = self.index[i]
+        return self.shards[s][offset:offset+int(np.prod(shape))].reshape(shape)
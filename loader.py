@@ -0,0 +1,93 @@
+import queue
+import threading
+import numpy as np
+import chainer
+
+## data iterator selected by --iterator
+## serial: loads in the main thread
+## thread: --loader_workers threads (decoding mostly holds the GIL, so this does not scale well)
+## process: --loader_workers processes returning examples through shared memory, with --loader_prefetch batches prefetched
+def make_iterator(dataset, batch_size, args, repeat=True, shuffle=True):
+    order_sampler = getattr(dataset, 'order_sampler', None) if shuffle else None
+    if order_sampler is not None:  # custom shuffling (e.g., volume-aware shuffling of DatasetStream)
+        shuffle = None
+    if args.iterator == 'serial':
+        return chainer.iterators.SerialIterator(dataset, batch_size, repeat=repeat, shuffle=shuffle, order_sampler=order_sampler)
+    elif args.iterator == 'thread':
+        return chainer.iterators.MultithreadIterator(dataset, batch_size, repeat=repeat, shuffle=shuffle, order_sampler=order_sampler,
+                                                     n_threads=args.loader_workers)
+    elif args.iterator == 'process':
+        # shared memory per example is measured from the first batch
+        return chainer.iterators.MultiprocessIterator(dataset, batch_size, repeat=repeat, shuffle=shuffle, order_sampler=order_sampler,
+                                                      n_processes=args.loader_workers, n_prefetch=args.loader_prefetch, shared_mem=None)
+    else:
+        raise ValueError("unknown iterator type: {}".format(args.iterator))
+
+## samples dataset[indices[i]] (unlike SubDataset, indices may contain repetitions)
+class IndexedSubset(chainer.dataset.DatasetMixin):
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_example(self, i):
+        return self.dataset[self.indices[i]]
+
+## the part of a dataset assigned to this worker in data-parallel training (of the same length for all the workers)
+## only indices are communicated since every worker has loaded the dataset
+## a dataset with volume-aware shuffling (DatasetStream) is scattered by volumes, keeping the shuffling within each worker
+def scatter_dataset(dataset, comm, seed=0):
+    import chainermn
+    order_sampler = getattr(dataset, 'order_sampler', None)
+    if hasattr(order_sampler, 'scatter'):
+        indices, order_sampler = order_sampler.scatter(comm.rank, comm.size)
+        sub = IndexedSubset(dataset, indices)
+        sub.order_sampler = order_sampler
+        return sub
+    b, e = chainermn.scatter_index(len(dataset), comm)
+    order = comm.bcast_obj(np.random.RandomState(seed).permutation(len(dataset)) if comm.rank == 0 else None)
+    return chainer.datasets.SubDataset(dataset, b, e, order)
+
+## assembles and converts the next pairs of A/B batches in a background thread while the current step runs
+## at most `depth` pairs are queued; the thread is started at the first call so that iterators can be restored from a snapshot beforehand
+## (the epoch counter of the iterators is ahead of the training by the queued batches)
+class PairPrefetcher():
+    def __init__(self, iter_x, iter_y, converter_x, converter_y, device, depth=2):
+        self.iter_x, self.iter_y = iter_x, iter_y
+        self.converter_x, self.converter_y = converter_x, converter_y
+        self.device = device
+        self.queue = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.thread = None
+
+    def _loop(self):
+        with chainer.using_device(chainer.get_device(self.device)):
+            while not self.stop.is_set():
+                try:
+                    item = (self.converter_x(self.iter_x.next(), self.device), self.converter_y(self.iter_y.next(), self.device))
+                except Exception as e:
+                    item = e
+                while not self.stop.is_set():
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if isinstance(item, Exception):
+                    return
+
+    def next(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def finalize(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
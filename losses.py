@@ -1,41 +1,62 @@
 import random
+import numpy as np
 import chainer
 import chainer.functions as F
 from chainer import Variable,cuda
 
+## history of generated images (pool_size of them) in a preallocated array, which is allocated at the first query
+## each image of a query is swapped with a random one in the pool with probability 1/2 (after the pool is filled)
 class ImagePool():
-    def __init__(self, pool_size):
+    def __init__(self, pool_size, seed=None):
         self.pool_size = pool_size
-        if self.pool_size > 0:
-            self.num_imgs = 0
-            self.images = []
+        self.random = np.random.RandomState(seed)  # with the same seed, data-parallel workers make the same choices
+        self.num_imgs = 0
+        self.images = None
 
     def query(self, images):
         if self.pool_size == 0:
             return images
-        return_images = []
         xp = cuda.get_array_module(images)
-        for image in images:
-            image = xp.expand_dims(image, axis=0)
-            if self.num_imgs < self.pool_size:
-                self.num_imgs = self.num_imgs + 1
-                self.images.append(image)
-                return_images.append(image)
-            else:
-                if random.choice([True, False]):
-                    random_id = random.randint(0, self.pool_size - 1)
-                    tmp = xp.copy(self.images[random_id])
-                    self.images[random_id] = image
-                    return_images.append(tmp)
-                else:
-                    return_images.append(image)
-        return_images = xp.concatenate(return_images)
+        if self.images is None or cuda.get_array_module(self.images) is not xp or len(self.images) != self.pool_size:
+            pool = xp.empty((self.pool_size,)+images.shape[1:], dtype=images.dtype)
+            if self.images is not None:  # restored from a snapshot
+                self.num_imgs = min(self.num_imgs, self.pool_size)
+                pool[:self.num_imgs] = xp.asarray(self.images[:self.num_imgs])
+            self.images = pool
+        return_images = images.copy()
+        # the first images fill the pool and are returned as they are
+        n = min(len(images), self.pool_size - self.num_imgs)
+        self.images[self.num_imgs:self.num_imgs+n] = images[:n]
+        self.num_imgs += n
+        idx = np.arange(n, len(images))[self.random.rand(len(images)-n) < 0.5]
+        if len(idx) == 0:
+            return return_images
+        slots = self.random.randint(0, self.pool_size, len(idx))
+        # when a slot is drawn more than once, the image swapped in by the earlier one is returned by the later one
+        order = np.lexsort((idx, slots))
+        same = slots[order[1:]] == slots[order[:-1]]
+        swapped = self.images[slots]
+        swapped[order[1:][same]] = images[idx[order[:-1][same]]]
+        return_images[idx] = swapped
+        last = order[np.append(~same, True)]
+        self.images[slots[last]] = images[idx[last]]
         return return_images
 
+    def serialize(self, serializer):
+        self.num_imgs = serializer('num_imgs', self.num_imgs)
+        self.images = serializer('images', self.images)
+        state = list(self.random.get_state())
+        state[1] = serializer('random_key', state[1])
+        state[2] = serializer('random_pos', state[2])
+        self.random.set_state(tuple(state))
+
 def add_noise(h, sigma): 
     xp = cuda.get_array_module(h.data)
     if chainer.config.train and sigma>0:
-        return h + sigma * xp.random.randn(*h.data.shape, dtype=h.dtype)
+        if xp is np:
+            return h + sigma * np.random.randn(*h.data.shape).astype(h.dtype)
+        else:
+            return h + sigma * xp.random.randn(*h.data.shape, dtype=h.dtype)
     else:
         return h
 
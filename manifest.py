@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+
+## bump this when the format of the manifest changes
+MANIFEST_VERSION = 1
+
+## persistent record of the files under a dataset root (sizes, mtimes, and z positions of DICOM slices)
+## a directory is listed again only when its mtime has changed; the recorded files are stat-ed at every scan
+## (files modified in place do not change the mtime of their directory), and headers are read only for new or modified files.
+## with readonly, changes are not saved (e.g., by the workers other than the first one in data-parallel training)
+class Manifest():
+    def __init__(self, root, store_dir=None, readonly=False):
+        self.root = os.path.abspath(root)
+        self.store_dir = store_dir
+        self.readonly = readonly
+        if store_dir:
+            name = hashlib.sha1(self.root.encode()).hexdigest()[:16]
+            self.fn = os.path.join(store_dir, 'manifest_{}.json'.format(name))
+        else:
+            self.fn = os.path.join(self.root, '.manifest.json')
+        self.dirs = {}
+        self.dirty = False
+        if os.path.exists(self.fn):
+            try:
+                with open(self.fn) as f:
+                    m = json.load(f)
+                if m.get('version') == MANIFEST_VERSION and m.get('root') == self.root:
+                    self.dirs = m['dirs']
+            except (OSError, ValueError):
+                print("broken manifest {}: rescanning".format(self.fn))
+        self.nscan = 0
+
+    def scan(self, dirname, ext):
+        ## return sorted files with extension ext and subdirectories under dirname
+        dirname = os.path.abspath(dirname)
+        mtime = os.stat(dirname).st_mtime_ns
+        rec = self.dirs.get(dirname)
+        # the directory is listed again if it has changed or a recorded file has disappeared
+        if rec is None or rec['mtime'] != mtime or rec['ext'] != ext or not self._restat(dirname, rec['files']):
+            old = rec['files'] if rec is not None else {}
+            files, subdirs = {}, []
+            for e in os.scandir(dirname):
+                if e.name.startswith('.'):
+                    continue
+                if e.is_dir():
+                    subdirs.append(e.name)
+                elif e.name.endswith(ext):
+                    st = e.stat()
+                    entry = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+                    prev = old.get(e.name)
+                    if prev is not None and 'z' in prev and prev['size']==entry['size'] and prev['mtime']==entry['mtime']:
+                        entry['z'] = prev['z']
+                    files[e.name] = entry
+            rec = {'mtime': mtime, 'ext': ext, 'files': files, 'subdirs': sorted(subdirs)}
+            self.dirs[dirname] = rec
+            self.dirty = True
+            self.nscan += 1
+        return [os.path.join(dirname, f) for f in sorted(rec['files'])], [os.path.join(dirname, d) for d in rec['subdirs']]
+
+    def _restat(self, dirname, files):
+        ## update the sizes and mtimes of the recorded files, forgetting the z positions of modified ones
+        for name,entry in files.items():
+            try:
+                st = os.stat(os.path.join(dirname, name))
+            except OSError:
+                return False
+            if entry['size'] != st.st_size or entry['mtime'] != st.st_mtime_ns:
+                files[name] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+                self.dirty = True
+        return True
+
+    def walk(self, ext):
+        ## recursively list files with extension ext under the root
+        names = []
+        stack = [self.root]
+        while stack:
+            files, subdirs = self.scan(stack.pop(), ext)
+            names.extend(files)
+            stack.extend(subdirs)
+        return sorted(names)
+
+    def _entry(self, f):
+        dirname, fname = os.path.split(os.path.abspath(f))
+        return self.dirs[dirname]['files'][fname]
+
+    def locations(self, files, read, mapper=map):
+        ## z positions of files; read(f) is called (through mapper) only for files not recorded yet
+        entries = [self._entry(f) for f in files]
+        missing = [i for i,e in enumerate(entries) if 'z' not in e]
+        if len(missing)>0:
+            for i,z in zip(missing, mapper(read, [files[i] for i in missing])):
+                entries[i]['z'] = z
+            self.dirty = True
+        return [e['z'] for e in entries]
+
+    def save(self):
+        if not self.dirty or self.readonly:
+            return
+        m = {'version': MANIFEST_VERSION, 'root': self.root, 'dirs': self.dirs}
+        try:
+            if self.store_dir:
+                # write to a temporary file first so that an interrupted job never leaves a truncated manifest
+                os.makedirs(self.store_dir, exist_ok=True)
+                tmp = "{}.{}.tmp".format(self.fn,os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(m, f)
+                os.replace(tmp, self.fn)
+            else:
+                # a manifest in the dataset root is overwritten in place since creating a file would change the mtime of the root
+                # (a broken manifest only causes a full rescan)
+                with open(self.fn, 'r+' if os.path.exists(self.fn) else 'w') as f:
+                    json.dump(m, f)
+                    f.truncate()
+            self.dirty = False
+        except OSError as e:
+            print("couldn't write manifest {}: {}".format(self.fn, e))
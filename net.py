@@ -143,6 +143,20 @@ class NonLocalBlock(chainer.Chain):
         o = self.o_conv(o)
         return x + self.gamma.W * o
 
+## activations inside the link are not stored but recomputed during backward (to save memory)
+def recompute(link, x, enabled=True):
+    if enabled and chainer.config.enable_backprop:
+        return F.forget(link, x)
+    return link(x)
+
+## which stages of the generator are recomputed (--gen_recompute)
+## not with dropout (different masks would be drawn) and batch normalisation (the running averages would be updated twice)
+def recompute_stages(args):
+    mode = getattr(args, 'gen_recompute', 'none')
+    if 'batch' in args.gen_norm:
+        mode = 'none'
+    return mode in ['resblock','all'], mode in ['cbr','all'] and not args.gen_dropout
+
 class ResBlock(chainer.Chain):
     def __init__(self, ch, norm='instance', activation='relu', equalised=False, separable=False, skip_conv=False):
         super(ResBlock, self).__init__()
@@ -265,6 +279,7 @@ class Encoder(chainer.Chain):
         else:
             self.unet = 'none'
         self.nfc = args.gen_fc
+        self.recompute_res, self.recompute_cbr = recompute_stages(args)
         with self.init_scope():
             for i in range(args.gen_fc):
                 self.in_c = args.ch
@@ -286,7 +301,7 @@ class Encoder(chainer.Chain):
         h = x
         for i in range(self.nfc):
             h=F.reshape(getattr(self, 'l' + str(i))(h),(-1,self.in_c,self.in_h,self.in_w))
-        e = self.c0(x)
+        e = recompute(self.c0, x, self.recompute_cbr)
         if self.unet=='conv':
             h = [self.s0(e)]
         elif self.unet in ['concat','add']:
@@ -294,7 +309,7 @@ class Encoder(chainer.Chain):
         else:
             h=[0]
         for i in range(1,len(self.chs)):
-            e = getattr(self, 'd' + str(i))(e)
+            e = recompute(getattr(self, 'd' + str(i)), e, self.recompute_cbr)
             if self.unet=='conv':
                 h.append(getattr(self, 's' + str(i))(e))
             elif self.unet in ['concat','add']:
@@ -304,7 +319,7 @@ class Encoder(chainer.Chain):
 #            print(h[-1].data.shape)
 #        e = F.max_pooling_2d(e,2,2)
         for i in range(self.n_resblock):
-            e = getattr(self, 'r' + str(i))(e)
+            e = recompute(getattr(self, 'r' + str(i)), e, self.recompute_res)
         h.append(e)
         if hasattr(self,'latent_fc'):
             h.append(self.latent_fc(e))
@@ -328,6 +343,7 @@ class Decoder(chainer.Chain):
             up_chs = [self.chs[i]+args.skipdim for i in range(len(self.chs))]
         else:    # ['add','none']:
             up_chs = self.chs
+        self.recompute_res, self.recompute_cbr = recompute_stages(args)
         with self.init_scope():
             if hasattr(args,'latent_dim') and args.latent_dim>0:
                 print("Latent dimensions: ",self.latent_c,self.latent_h,self.latent_w)
@@ -350,16 +366,15 @@ class Decoder(chainer.Chain):
             e = F.reshape(self.latent_fc(e),(-1,self.latent_c,self.latent_h,self.latent_w))
             e = self.latent_ac(self.latent_n(e))
         for i in range(self.n_resblock):
-            e = getattr(self, 'r' + str(i))(e)
+            e = recompute(getattr(self, 'r' + str(i)), e, self.recompute_res)
 #        e = bilinear_upsampling(e)
         for i in range(1,len(self.chs)+1):
             if self.unet in ['conv','concat']:
-                e = getattr(self, 'ua' + str(i))(F.concat([e,h[-i-1]]))
+                e = F.concat([e,h[-i-1]])
             elif self.unet=='add':
-                e = getattr(self, 'ua' + str(i))(e+h[-i-1])
-            else:
-                e = getattr(self, 'ua' + str(i))(e)
-        e = self.ul(e)
+                e = e+h[-i-1]
+            e = recompute(getattr(self, 'ua' + str(i)), e, self.recompute_cbr)
+        e = recompute(self.ul, e, self.recompute_cbr)
         return e
 
 class Generator(chainer.Chain):
@@ -375,7 +390,10 @@ class Generator(chainer.Chain):
     def __call__(self, x):
         h = self.encoder(x)
         if chainer.config.train and self.noise_z>0:
-            h.data += self.noise_z * h.xp.random.randn(*h.data.shape, dtype=h.dtype)
+            if h.xp is np:
+                h.data += self.noise_z * np.random.randn(*h.data.shape).astype(h.dtype)
+            else:
+                h.data += self.noise_z * h.xp.random.randn(*h.data.shape, dtype=h.dtype)
         return self.decoder(h)
 
 class Discriminator(chainer.Chain):
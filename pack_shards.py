@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#############################
+##
+## Pack images under trainA, trainB, testA, testB into large shard files
+## which are memory-mapped by dataset_jpg.DatasetShard (use --shards in train.py and convert.py)
+##
+#############################
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from arguments import arguments
+from dataset_jpg import DatasetOutMem, SHARD_VERSION
+
+def pack(dataset, outdir, shard_bytes, workers=1):
+    os.makedirs(outdir, exist_ok=True)
+    index = {'version': SHARD_VERSION, 'imgtype': dataset.imgtype, 'color': dataset.color, 'shards': [], 'images': []}
+    buf, size = [], 0
+    dtype = None
+    def flush():
+        fn = 'shard_{:05d}.npy'.format(len(index['shards']))
+        np.save(os.path.join(outdir, fn), np.concatenate(buf))
+        index['shards'].append(fn)
+        print("{}: {} images, {:.1f} MB".format(os.path.join(outdir, fn), len(buf), size/1024**2))
+    chunk = 64*max(1,workers)
+    with ThreadPoolExecutor(max(1,workers)) as pool:
+        for k in range(0,len(dataset),chunk):
+            for i,img in enumerate(pool.map(dataset.read, range(k,min(k+chunk,len(dataset)))), k):
+                if dtype is None:
+                    dtype = img.dtype
+                elif img.dtype != dtype:
+                    print("{} is converted from {} to {}".format(dataset.get_img_path(i), img.dtype, dtype))
+                    img = img.astype(dtype)
+                if size+img.nbytes > shard_bytes and len(buf)>0:
+                    flush()
+                    buf, size = [], 0
+                index['images'].append([dataset.get_img_path(i), len(index['shards']), size//img.itemsize, img.shape])
+                buf.append(img.ravel())
+                size += img.nbytes
+    if len(buf)>0:
+        flush()
+    with open(os.path.join(outdir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+if __name__ == '__main__':
+    args = arguments()
+    if args.imgtype=="dcm":
+        print("DICOM volumes cannot be packed: use --cache_dir instead")
+        exit()
+    for d in ['trainA','trainB','testA','testB']:
+        path = os.path.join(args.root, d)
+        if os.path.isdir(path):
+            dataset = DatasetOutMem(path=path, args=args, base=args.HU_baseA, rang=args.HU_rangeA)
+            pack(dataset, os.path.join(args.out, d), args.shard_mb*1024**2, args.load_workers)
+    print("\nshards are saved under: {}\nuse them by: python train.py -R {} -it {}{} --shards".format(args.out, args.out, args.imgtype, " --grey" if args.grey else ""))
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import chainer
+from chainer import cuda
+
+## per-phase timing of the training steps (--profile)
+## with prof(name): ... times a phase; the time of nested phases is excluded from that of the enclosing phase,
+## and the total of each phase in the step is reported as time/<name>
+## the phases are also recorded as complete events of the Chrome trace format (chrome://tracing or https://ui.perfetto.dev),
+## which are written to trace_<iteration>.json under out every interval iterations
+## on GPU, the device is synchronised at the end of each phase so that asynchronous kernels are counted in the phase launching them
+class Profiler():
+    def __init__(self, out=None, interval=100, sync=False):
+        self.out = out
+        self.interval = interval
+        self.sync = sync
+        self.origin = time.perf_counter()
+        self.stack = []
+        self.totals = {}
+        self.events = []
+        if out:
+            os.makedirs(out, exist_ok=True)
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        self.stack.append([self.name, time.perf_counter(), 0])
+        return self
+
+    def __exit__(self, *exc):
+        if self.sync:
+            cuda.Stream.null.synchronize()
+        end = time.perf_counter()
+        name, start, inner = self.stack.pop()
+        self.totals[name] = self.totals.get(name, 0) + end - start - inner
+        if self.stack:
+            self.stack[-1][2] += end - start
+        if self.out:
+            self.events.append((name, start, end - start))
+        return False
+
+    ## report the totals of the step, and write the trace every interval iterations
+    def step(self, iteration):
+        chainer.report({'time/'+name: t for name,t in self.totals.items()})
+        self.totals = {}
+        if self.out and iteration % self.interval == 0:
+            trace = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': 1e6*(start-self.origin), 'dur': 1e6*dur}
+                     for name,start,dur in self.events]
+            with open(os.path.join(self.out, 'trace_{:08d}.json'.format(iteration)), 'w') as f:
+                json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+            self.events = []
+
+## used when profiling is off: phases are not timed at all
+class NullProfiler():
+    def __call__(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def step(self, iteration):
+        pass
+
+## names of the phases timed in a training step under the given arguments (for the log keys)
+def phases(args):
+    names = ['data'] + ([] if args.batch_prefetch>0 else ['to_device']) + ['gen_forward', 'gen_backward']
+    names += ['update/'+opt for opt in ['opt_enc_x','opt_dec_x','opt_enc_y','opt_dec_y'] if not (args.single_encoder and opt=='opt_enc_y')]
+    dis = [opt for opt,l in [('opt_x',args.lambda_dis_x),('opt_y',args.lambda_dis_y),('opt_z',args.lambda_dis_z)] if l>0]
+    names += [p+'/'+opt for opt in dis for p in ['dis_forward','dis_backward','update']]
+    if args.lambda_dis_x>0 or args.lambda_dis_y>0:
+        names.append('pool')
+    return names
@@ -12,17 +12,19 @@ from chainer.links.connection.linear import Linear
 import chainer.functions as F
 
 def _l2normalize(v, eps=1e-12):
-    norm = cuda.reduce('T x', 'T out',
-                       'x * x', 'a + b', 'out = sqrt(a)', 0,
-                       'norm_sn')
-    div = cuda.elementwise('T x, T norm, T eps',
-                           'T out',
-                           'out = x / (norm + eps)',
-                           'div_sn')
-    return div(v, norm(v), eps)
+    # in place; works for both numpy and cupy arrays
+    xp = cuda.get_array_module(v)
+    v /= xp.sqrt(xp.sum(v * v)) + eps
+    return v
 
+def _buffer(buffers, key, shape, dtype, xp):
+    # work arrays of the power iteration are kept in buffers and reused
+    b = buffers.get(key)
+    if b is None or b.shape != shape or b.dtype != dtype or cuda.get_array_module(b) is not xp:
+        b = buffers[key] = xp.empty(shape, dtype=dtype)
+    return b
 
-def max_singular_value(W, u=None, Ip=1):
+def max_singular_value(W, u=None, Ip=1, buffers=None):
     """
     Apply power iteration for the weight parameter
     """
@@ -32,10 +34,15 @@ def max_singular_value(W, u=None, Ip=1):
     xp = cuda.get_array_module(W.data)
     if u is None:
         u = xp.random.normal(size=(1, W.shape[0])).astype(xp.float32)
-    _u = u
+    if buffers is None:
+        buffers = {}
+    dtype = xp.result_type(u.dtype, W.dtype)
+    _v = _buffer(buffers, 'v', (1, W.shape[1]), dtype, xp)
+    _u = _buffer(buffers, 'u', (1, W.shape[0]), dtype, xp)
+    _u[:] = u
     for _ in range(Ip):
-        _v = _l2normalize(xp.dot(_u, W.data), eps=1e-12)
-        _u = _l2normalize(xp.dot(_v, W.data.transpose()), eps=1e-12)
+        _l2normalize(xp.dot(_u, W.data, out=_v), eps=1e-12)
+        _l2normalize(xp.dot(_v, W.data.transpose(), out=_u), eps=1e-12)
     sigma = F.sum(F.linear(_u, F.transpose(W)) * _v)
     return sigma, _u, _v
 
@@ -56,7 +63,22 @@ def max_singular_value_fully_differentiable(W, u=None, Ip=1):
         _u = F.normalize(F.matmul(_v, F.transpose(W)), eps=1e-12)
     _u = F.matmul(_v, F.transpose(W))
     norm = F.sqrt(F.sum(_u ** 2))
-    return norm, _l2normalize(_u.data), _v
+    return norm, _l2normalize(_u.data.copy()), _v
+
+def _cached_W_bar(link, compute):
+    """
+    W_bar is computed once per update of W (and per train/test mode) and shared by all the forward passes in between,
+    so that the power iteration runs once per iteration
+    """
+    rule = link.W.update_rule
+    if not link.cache_W_bar or rule is None:
+        return compute(None)
+    key = (rule.t, chainer.config.train)
+    cache = getattr(link, '_W_bar_cache', None)
+    if cache is None or cache[0] != key or cache[1] is not link.W.array:
+        # buffers are reused only here: the graph of the previous W_bar has been consumed when W is updated
+        link._W_bar_cache = (key, link.W.array, compute(link._sn_buffers))
+    return link._W_bar_cache[2]
 
 class SNConvolution2D(Convolution2D):
     """Two-dimensional convolutional layer with spectral normalization.
@@ -106,6 +128,8 @@ class SNConvolution2D(Convolution2D):
 
     """
 
+    cache_W_bar = True
+
     def __init__(self, in_channels, out_channels, ksize, stride=1, pad=0,
                  nobias=False, initialW=None, initial_bias=None, use_gamma=False, Ip=1, factor=None):
         self.Ip = Ip
@@ -116,14 +140,18 @@ class SNConvolution2D(Convolution2D):
             nobias, initialW, initial_bias)
         self.u = np.random.normal(size=(1, out_channels)).astype(dtype="f")
         self.register_persistent('u')
+        self._sn_buffers = {}
 
     @property
     def W_bar(self):
         """
         Spectrally Normalized Weight
         """
+        return _cached_W_bar(self, self._W_bar)
+
+    def _W_bar(self, buffers):
         W_mat = self.W.reshape(self.W.shape[0], -1)
-        sigma, _u, _ = max_singular_value(W_mat, self.u, self.Ip)
+        sigma, _u, _ = max_singular_value(W_mat, self.u, self.Ip, buffers)
         if self.factor:
             sigma = sigma / self.factor
         sigma = broadcast_to(sigma.reshape((1, 1, 1, 1)), self.W.shape)
@@ -193,6 +221,8 @@ class SNLinear(Linear):
         (optional) factor (float): constant factor to adjust spectral norm of W_bar.
     """
 
+    cache_W_bar = True
+
     def __init__(self, in_size, out_size, use_gamma=False, nobias=False,
                  initialW=None, initial_bias=None, Ip=1, factor=None):
         self.Ip = Ip
@@ -203,13 +233,17 @@ class SNLinear(Linear):
         )
         self.u = np.random.normal(size=(1, out_size)).astype(dtype="f")
         self.register_persistent('u')
+        self._sn_buffers = {}
 
     @property
     def W_bar(self):
         """
         Spectral Normalized Weight
         """
-        sigma, _u, _ = max_singular_value(self.W, self.u, self.Ip)
+        return _cached_W_bar(self, self._W_bar)
+
+    def _W_bar(self, buffers):
+        sigma, _u, _ = max_singular_value(self.W, self.u, self.Ip, buffers)
         if self.factor:
             sigma = sigma / self.factor
         sigma = broadcast_to(sigma.reshape((1, 1)), self.W.shape)
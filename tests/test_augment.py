@@ -0,0 +1,45 @@
+import os
+import argparse
+import sys
+import numpy as np
+import pytest
+from chainercv.transforms import center_crop
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from augment import center_offsets, window, augment, BatchAugment
+
+## crop of the reference path: edge padding, center_crop to (H+2r,W+2r), and the crop at (dy,dx)
+def reference(img, H, W, r, dy, dx):
+    if img.shape[1]<H+2*r or img.shape[2]<W+2*r:
+        p = max(H+2*r-img.shape[1],W+2*r-img.shape[2])
+        img = np.pad(img,((0,0),(p,p),(p,p)),'edge')
+    img = center_crop(img,(H+2*r,W+2*r))
+    return img[:, dy:dy+H, dx:dx+W]
+
+## images smaller than the translation range, for which the window may lie entirely outside the image
+@pytest.mark.parametrize('shape,H,W,r', [((3,29,3),1,1,4), ((1,3,29),2,1,4), ((3,2,2),1,1,3), ((1,5,7),4,4,2)])
+def test_tiny_image(shape, H, W, r):
+    img = np.arange(np.prod(shape), dtype=np.uint8).reshape(shape)
+    top, left = center_offsets(shape[1], shape[2], H+2*r, W+2*r)
+    for dy in range(2*r+1):
+        for dx in range(2*r+1):
+            ref = reference(img, H, W, r, dy, dx)
+            np.testing.assert_array_equal(window(img, top+dy, left+dx, H, W), ref)
+            out = augment(img, top+dy, left+dx, H, W, 0, 255)
+            np.testing.assert_allclose(out, ref.astype(np.float32)/127.5-1.0, atol=1e-6)
+            out = augment(img, top+dy, left+dx, H, W, 0, 255, flip=True)
+            np.testing.assert_allclose(out, ref[:,:,::-1].astype(np.float32)/127.5-1.0, atol=1e-6)
+
+## BatchAugment gives the crops of augment() at the same offsets and flips
+@pytest.mark.parametrize('dtype,base,rang', [(np.uint8,0,255), (np.int16,-500,1000)])
+def test_batch_augment(dtype, base, rang):
+    H, W, r, n = 6, 5, 3, 4
+    info = np.iinfo(dtype)
+    raws = [np.random.randint(info.min, info.max, (3,H+2*r,W+2*r)).astype(dtype) for _ in range(n)]
+    dataset = argparse.Namespace(crop=(H,W), random=r, flip=True, dtype=np.float32, norm_range=lambda: (base,rang))
+    np.random.seed(0)
+    out = BatchAugment(dataset)(raws)
+    np.random.seed(0)
+    dy, dx, flip = np.random.randint(0, 2*r+1, n), np.random.randint(0, 2*r+1, n), np.random.rand(n) < 0.5
+    for i in range(n):
+        np.testing.assert_allclose(out[i], augment(raws[i], dy[i], dx[i], H, W, base, rang, flip=flip[i]), atol=1e-6)
@@ -20,6 +20,9 @@ from net import Encoder,Decoder
 from arguments import arguments 
 from updater import Updater
 from visualization import VisEvaluator
+from augment import BatchAugment
+from loader import make_iterator, scatter_dataset
+from profiler import phases
 from consts import dtypes,optim
 
 def plot_ylimit(f,a,summary):
@@ -32,16 +35,47 @@ def main():
     print(args)
 
     if args.imgtype=="dcm":
-        from dataset_dicom import Dataset as Dataset 
+        if args.stream:
+            from dataset_dicom import DatasetStream as Dataset
+        else:
+            from dataset_dicom import Dataset as Dataset
+    elif args.shards:
+        from dataset_jpg import DatasetShard as Dataset
+    elif args.inmem:
+        from dataset_jpg import DatasetInMem as Dataset
     else:
         from dataset_jpg import DatasetOutMem as Dataset   
 
+    # data-parallel training over processes launched by mpiexec (ChainerMN)
+    comm = None
+    if args.mpi:
+        import chainermn
+        if args.gpu[0] >= 0:
+            comm = chainermn.create_communicator('pure_nccl')
+            args.gpu = [comm.intra_rank]
+        else:
+            comm = chainermn.create_communicator('naive')
+        args.out = comm.bcast_obj(args.out if comm.rank == 0 else None)
+        print("worker {} of {}".format(comm.rank, comm.size))
+    is_master = comm is None or comm.rank == 0
+    args.manifest_readonly = not is_master   # only the first worker saves the manifests
+
     # CUDA
-    if not chainer.cuda.available:
-        print("CUDA required")
-        exit()
-    if len(args.gpu)==1 and args.gpu[0] >= 0:
-        chainer.cuda.get_device_from_id(args.gpu[0]).use()
+    if args.gpu[0] >= 0:
+        if not chainer.cuda.available:
+            print("CUDA required: use -g -1 for training on CPU")
+            exit()
+        if len(args.gpu)==1:
+            chainer.cuda.get_device_from_id(args.gpu[0]).use()
+    else:
+        # iDeep (intel64) is used if installed
+        chainer.config.use_ideep = 'auto'
+        if args.cpu_threads>0:
+            try:
+                from threadpoolctl import threadpool_limits
+                threadpool_limits(args.cpu_threads)
+            except ImportError:
+                print("threadpoolctl is not installed: set OMP_NUM_THREADS instead of --cpu_threads")
 
     # Enable autotuner of cuDNN
     chainer.config.autotune = True
@@ -64,16 +98,36 @@ def main():
     test_B_dataset = Dataset(
         path=os.path.join(args.root, 'testB'), args=args, base=args.HU_baseB, rang=args.HU_rangeB, random=0)
 
+    if args.imgtype=="dcm" and args.stream:
+        # the memory budget is shared by the datasets (most of it by the training ones)
+        for d,share in [(train_A_dataset,0.4),(train_B_dataset,0.4),(test_A_dataset,0.1),(test_B_dataset,0.1)]:
+            d.budget = int(share * args.volume_cache_mb * 1024**2)
+            print("memory budget for volumes under {}: {:.1f} MB".format(d.path, d.budget/1024**2))
+
     args.ch = train_A_dataset.ch
     args.out_ch = train_B_dataset.ch
     print("channels in A {}, channels in B {}".format(args.ch,args.out_ch))
 
 #    test_A_iter = chainer.iterators.SerialIterator(test_A_dataset, args.nvis_A, shuffle=False)
 #    test_B_iter = chainer.iterators.SerialIterator(test_B_dataset, args.nvis_B, shuffle=False)
-    test_A_iter = chainer.iterators.MultithreadIterator(test_A_dataset, args.nvis_A, shuffle=False, n_threads=3)
-    test_B_iter = chainer.iterators.MultithreadIterator(test_B_dataset, args.nvis_B, shuffle=False, n_threads=3)   
-    train_A_iter = chainer.iterators.MultithreadIterator(train_A_dataset, args.batch_size, n_threads=3)
-    train_B_iter = chainer.iterators.MultithreadIterator(train_B_dataset, args.batch_size, n_threads=3)
+    test_A_iter = make_iterator(test_A_dataset, args.nvis_A, args, shuffle=False)
+    test_B_iter = make_iterator(test_B_dataset, args.nvis_B, args, shuffle=False)
+    if comm:   # each worker iterates over its own part of the datasets
+        train_A_iter = make_iterator(scatter_dataset(train_A_dataset, comm), args.batch_size, args)
+        train_B_iter = make_iterator(scatter_dataset(train_B_dataset, comm), args.batch_size, args)
+    else:
+        train_A_iter = make_iterator(train_A_dataset, args.batch_size, args)
+        train_B_iter = make_iterator(train_B_dataset, args.batch_size, args)
+
+    if train_A_dataset.batch_augment:
+        converter = BatchAugment(train_A_dataset)
+        converter_B = BatchAugment(train_B_dataset)
+    elif args.batch_prefetch>0:   # the transfer is done in the background thread
+        converter = convert.concat_examples
+        converter_B = converter
+    else:
+        converter = convert.ConcatWithAsyncTransfer()
+        converter_B = converter
 
     # setup models
     enc_x = Encoder(args)
@@ -97,18 +151,26 @@ def main():
                 pass
 
     # select GPU
-    if len(args.gpu) == 1:
+    if len(args.gpu) != 1:
+        print("currently only a single GPU can be used")
+        exit()
+    elif args.gpu[0] >= 0:
         for e in models:
             models[e].to_gpu()
         print('using gpu {}, cuDNN {}'.format(args.gpu, chainer.cuda.cudnn_enabled))
+    elif chainer.backends.intel64.is_ideep_available():
+        for e in models:
+            models[e].to_intel64()
+        print('using CPU with iDeep')
     else:
-        print("mandatory GPU use: currently only a single GPU can be used")
-        exit()
+        print('using CPU')
 
     # Setup optimisers
     def make_optimizer(model, lr, opttype='Adam'):
 #        eps = 1e-5 if args.dtype==np.float16 else 1e-8
         optimizer = optim[opttype](lr)
+        if comm:   # gradients are averaged over the workers
+            optimizer = chainermn.create_multi_node_optimizer(optimizer, comm)
         #from profiled_optimizer import create_marked_profile_optimizer
 #        optimizer = create_marked_profile_optimizer(optim[opttype](lr), sync=True, sync_level=2)
         optimizer.setup(model)
@@ -149,12 +211,27 @@ def main():
             'train_B': train_B_iter,
         },
         optimizer=optimizers,
-        converter=convert.ConcatWithAsyncTransfer(),
+        converter=converter,
         device=args.gpu[0],
         params={
-            'args': args
+            'args': args,
+            'converter_B': converter_B,
+            'trace_dir': os.path.join(args.out,'trace') if comm is None or comm.rank == 0 else None,
+            'pool_seed': comm.bcast_obj(np.random.randint(2**31) if comm.rank == 0 else None) if comm else None
         })
 
+    # the image pools are saved and restored together with the optimisers
+    pools = {'pool_x': updater._buffer_x, 'pool_y': updater._buffer_y}
+    if args.load_optimizer:
+        for e in pools:
+            try:
+                m = args.load_models.replace('enc_x',e)
+                serializers.load_npz(m, pools[e])
+                print('image pool loaded: {}'.format(m))
+            except:
+                print("couldn't load {}".format(m))
+                pass
+
     if args.snapinterval<0:
         args.snapinterval = args.lrdecay_start+args.lrdecay_period
     log_interval = (200, 'iteration')
@@ -168,6 +245,17 @@ def main():
     else:
         stop_trigger = (args.lrdecay_start + args.lrdecay_period, 'epoch')
     trainer = training.Trainer(updater, stop_trigger, out=args.out)
+    # learning rate scheduling
+    decay_start_iter = len(train_A_iter.dataset) * args.lrdecay_start
+    decay_end_iter = len(train_A_iter.dataset) * (args.lrdecay_start+args.lrdecay_period)
+    for e in [opt_enc_x,opt_enc_y,opt_dec_x,opt_dec_y]:
+        trainer.extend(extensions.LinearShift('alpha', (args.learning_rate_g,0), (decay_start_iter,decay_end_iter), optimizer=e))
+    for e in [opt_x,opt_y,opt_z]:
+        trainer.extend(extensions.LinearShift('alpha', (args.learning_rate_d,0), (decay_start_iter,decay_end_iter), optimizer=e))
+    if not is_master:  # snapshots, logs, and visualisation are done by the master
+        trainer.run()
+        return
+
     for e in models:
         trainer.extend(extensions.snapshot_object(
             models[e], e+'{.updater.epoch}.npz'), trigger=model_save_interval)
@@ -175,11 +263,17 @@ def main():
     for e in optimizers:
         trainer.extend(extensions.snapshot_object(
             optimizers[e], e+'{.updater.epoch}.npz'), trigger=model_save_interval)
+    for e in pools:
+        trainer.extend(extensions.snapshot_object(
+            pools[e], e+'{.updater.epoch}.npz'), trigger=model_save_interval)
 
     log_keys = ['epoch', 'iteration','lr']
     log_keys_cycle = ['opt_enc_x/loss_cycle', 'opt_enc_y/loss_cycle', 'opt_dec_x/loss_cycle',  'opt_dec_y/loss_cycle', 'myval/cycle_x_l1', 'myval/cycle_y_l1']
     log_keys_adv = ['opt_enc_y/loss_adv','opt_dec_y/loss_adv','opt_enc_x/loss_adv','opt_dec_x/loss_adv']
     log_keys_d = []
+    log_keys_time = ['time/data_wait']
+    if args.profile:
+        log_keys_time.extend(['time/'+p for p in phases(args)])
     if args.lambda_reg>0:
         log_keys.extend(['opt_enc_x/loss_reg','opt_enc_y/loss_reg'])
     if args.lambda_tv>0:
@@ -203,18 +297,11 @@ def main():
         if args.lambda_dis_z>0:
             log_keys_d.extend(['opt_z/loss_x','opt_z/loss_y'])
 
-    log_keys_all = log_keys+log_keys_d+log_keys_adv+log_keys_cycle
+    log_keys_all = log_keys+log_keys_d+log_keys_adv+log_keys_cycle+log_keys_time
     trainer.extend(extensions.LogReport(keys=log_keys_all, trigger=log_interval))
     trainer.extend(extensions.PrintReport(log_keys_all), trigger=log_interval)
     trainer.extend(extensions.ProgressBar(update_interval=20))
     trainer.extend(extensions.observe_lr(optimizer_name='opt_enc_x'), trigger=log_interval)
-    # learning rate scheduling
-    decay_start_iter = len(train_A_dataset) * args.lrdecay_start
-    decay_end_iter = len(train_A_dataset) * (args.lrdecay_start+args.lrdecay_period)
-    for e in [opt_enc_x,opt_enc_y,opt_dec_x,opt_dec_y]:
-        trainer.extend(extensions.LinearShift('alpha', (args.learning_rate_g,0), (decay_start_iter,decay_end_iter), optimizer=e))
-    for e in [opt_x,opt_y,opt_z]:
-        trainer.extend(extensions.LinearShift('alpha', (args.learning_rate_d,0), (decay_start_iter,decay_end_iter), optimizer=e))
     ## dump graph
     if args.lambda_Az>0:
         trainer.extend(extensions.dump_graph('opt_enc_x/loss_cycle', out_name='gen.dot'))
@@ -256,7 +343,8 @@ def main():
     rundir = os.path.dirname(os.path.realpath(__file__))
     import zipfile
     with zipfile.ZipFile(os.path.join(args.out,'script.zip'), 'w', compression=zipfile.ZIP_DEFLATED) as new_zip:
-        for f in ['train.py','net.py','updater.py','consts.py','losses.py','arguments.py','convert.py']:
+        for f in ['train.py','net.py','updater.py','consts.py','losses.py','arguments.py','convert.py','sn.py',
+                  'dataset_jpg.py','dataset_dicom.py','augment.py','manifest.py','loader.py','profiler.py']:
             new_zip.write(os.path.join(rundir,f),arcname=f)
 
     # Run the training
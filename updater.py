@@ -1,9 +1,32 @@
 import random
+import numpy as np
+import time
 import chainer
 import chainer.functions as F
 from chainer import Variable,cuda
 from chainer.links import VGG16Layers
 import losses
+from loader import PairPrefetcher
+from profiler import Profiler, NullProfiler
+
+## helpers for running a network once on several inputs
+## encoder outputs are lists (for u-net) which may contain placeholders (0) in place of skip connections
+def _batch_len(h):
+    return _batch_len(h[-1]) if isinstance(h, list) else len(h)
+
+def _concat(hs):
+    if isinstance(hs[0], list):
+        return [_concat(list(h)) for h in zip(*hs)]
+    if isinstance(hs[0], int):
+        return hs[0]
+    return F.concat(hs, axis=0)
+
+def _split(h, sizes):
+    if isinstance(h, list):
+        return [list(hs) for hs in zip(*[_split(e, sizes) for e in h])]
+    if isinstance(h, int):
+        return [h]*len(sizes)
+    return F.split_axis(h, np.cumsum(sizes)[:-1], axis=0)
 
 class Updater(chainer.training.StandardUpdater):
     def __init__(self, *args, **kwargs):
@@ -12,31 +35,151 @@ class Updater(chainer.training.StandardUpdater):
 #        self.device_id = kwargs.pop('device')
         super(Updater, self).__init__(*args, **kwargs)
         self.args = params['args']
+        self.converter_y = params.get('converter_B', self.converter)
+        if self.args.batch_prefetch>0:
+            self.prefetcher = PairPrefetcher(self.get_iterator('main'), self.get_iterator('train_B'), self.converter, self.converter_y, self.args.gpu[0], self.args.batch_prefetch)
+        else:
+            self.prefetcher = None
         self.xp = self.enc_x.xp
-        self._buffer_y = losses.ImagePool(50 * self.args.batch_size)
-        self._buffer_x = losses.ImagePool(50 * self.args.batch_size)
+        # inputs to the same generator (resp. discriminator) are concatenated along the batch axis and fed in a single forward pass
+        # (not with batch normalisation, where the statistics would be taken over the concatenated batch)
+        self.batch_gen = not self.args.gen_separate_passes and 'batch' not in self.args.gen_norm
+        self.batch_dis = not self.args.dis_separate_passes and 'batch' not in self.args.dis_norm
+        # per-phase timing (the trace is written only when a directory is given)
+        if self.args.profile:
+            self.prof = Profiler(params.get('trace_dir'), self.args.profile_interval, sync=self.args.gpu[0]>=0)
+        else:
+            self.prof = NullProfiler()
+        seed = params.get('pool_seed')
+        self._buffer_y = losses.ImagePool(50 * self.args.batch_size, seed)
+        self._buffer_x = losses.ImagePool(50 * self.args.batch_size, None if seed is None else seed+1)
         if self.args.lambda_identity_x > 0 or self.args.lambda_identity_y > 0:
             self.vgg = VGG16Layers()  # for perceptual loss
-            self.vgg.to_gpu()
+            if self.args.gpu[0] >= 0:
+                self.vgg.to_gpu()
+
+    ## apply f to each of xs (None is skipped and gives None)
+    def _passes(self, f, xs, batched):
+        idx = [i for i,x in enumerate(xs) if x is not None]
+        out = [None]*len(xs)
+        if batched and len(idx)>1:
+            ys = _split(f(_concat([xs[i] for i in idx])), [_batch_len(xs[i]) for i in idx])
+        else:
+            ys = [f(xs[i]) for i in idx]
+        for i,y in zip(idx,ys):
+            out[i] = y
+        return out
 
+    ## WGAN loss of a discriminator with the gradient penalty, which is computed every gp_interval steps with the weight multiplied by gp_interval
+    ## wgan: (|grad D|-1)^2 at random interpolations of fake and real samples
+    ## r1: |grad D|^2/2 at real samples (the forward pass for the loss is reused, so no extra pass is needed)
+    def _loss_dis_wgan(self, dis, fake, real):
+        gp = self.args.lambda_wgan_gp>0 and self.iteration % self.args.gp_interval == 0
+        if gp and self.args.gp_type=='r1':
+            real = Variable(real.array)
+            dis_fake, dis_real = dis(fake), dis(real)
+            gd, = chainer.grad([dis_real], [real], enable_double_backprop=True)
+            loss_gp = 0.5 * F.average(F.batch_l2_norm_squared(gd))
+        else:
+            dis_fake, dis_real = self._passes(dis, [fake, real], self.batch_dis)
+            if gp:
+                eps = self.xp.random.uniform(0, 1, size=len(real)).astype(self.xp.float32)[:, None, None, None]
+                mid = eps * real + (1.0 - eps) * fake
+                gd, = chainer.grad([dis(mid)], [mid], enable_double_backprop=True)
+                gd = F.sqrt(F.batch_l2_norm_squared(gd) + 1e-6)
+                loss_gp = F.mean_squared_error(gd, self.xp.ones_like(gd.data))
+        loss_dis = F.average(dis_fake-dis_real)
+        chainer.report({'loss_dis': loss_dis}, dis)
+        if gp:
+            chainer.report({'loss_gp': self.args.lambda_wgan_gp * loss_gp}, dis)
+            loss_dis = loss_dis + self.args.gp_interval * self.args.lambda_wgan_gp * loss_gp
+        return loss_dis
+
+    def finalize(self):
+        if self.prefetcher:
+            self.prefetcher.finalize()
+        super(Updater, self).finalize()
+
+    ## the gradients are accumulated over accum_steps micro-batches, and then each model is updated once
+    ## (the generators first, and then the discriminators on the samples queried from the image pools, as with a single batch)
     def update_core(self):
-        opt_enc_x = self.get_optimizer('opt_enc_x')
-        opt_dec_x = self.get_optimizer('opt_dec_x')
-        opt_enc_y = self.get_optimizer('opt_enc_y')
-        opt_dec_y = self.get_optimizer('opt_dec_y')
-        opt_x = self.get_optimizer('opt_x')
-        opt_y = self.get_optimizer('opt_y')
-        opt_z = self.get_optimizer('opt_z')
+        accum = self.args.accum_steps
+        observations = [{} for _ in range(accum)]
+        dis_inputs = []
+        data_wait = 0
+        self.enc_x.cleargrads()
+        self.dec_x.cleargrads()
+        self.enc_y.cleargrads()
+        self.dec_y.cleargrads()
+        for observation in observations:
+            start = time.perf_counter()
+            x, y = self._next_batch()
+            data_wait += time.perf_counter()-start
+            with chainer.reporter.report_scope(observation), self.prof('gen_forward'):
+                loss_gen, inputs = self._loss_gen(x, y)
+            if accum > 1:
+                loss_gen = loss_gen / accum
+            with self.prof('gen_backward'):
+                loss_gen.backward()
+            dis_inputs.append(inputs)
+        chainer.report({'time/data_wait': data_wait})
+        for opt in ['opt_enc_x','opt_dec_x','opt_enc_y','opt_dec_y']:
+            if opt=='opt_enc_y' and self.args.single_encoder:
+                continue
+            with self.prof('update/'+opt):
+                self.get_optimizer(opt).update(loss=loss_gen)
 
-        # get mini-batch
-        batch_x = self.get_iterator('main').next()
-        batch_y = self.get_iterator('train_B').next()
-        x = Variable(self.converter(batch_x, self.args.gpu[0]))
-        y = Variable(self.converter(batch_y, self.args.gpu[0]))
+        self.dis_x.cleargrads()
+        self.dis_y.cleargrads()
+        self.dis_z.cleargrads()
+        for observation, inputs in zip(observations, dis_inputs):
+            with chainer.reporter.report_scope(observation):
+                loss_dis = self._loss_dis(*inputs)
+            for opt in loss_dis:
+                if accum > 1:
+                    loss_dis[opt] = loss_dis[opt] / accum
+                with self.prof('dis_backward/'+opt):
+                    loss_dis[opt].backward()
+        for opt in loss_dis:
+            with self.prof('update/'+opt):
+                self.get_optimizer(opt).update(loss=loss_dis[opt])
 
+        # losses are averaged over the micro-batches
+        for key in observations[0]:
+            chainer.report({key: sum(observation[key] for observation in observations) / accum if accum > 1 else observations[0][key]})
+        self.prof.step(self.iteration+1)
+
+    def _next_batch(self):
+        if self.prefetcher:
+            with self.prof('data'):
+                x, y = self.prefetcher.next()
+            return Variable(x), Variable(y)
+        with self.prof('data'):
+            batch_x = self.get_iterator('main').next()
+            batch_y = self.get_iterator('train_B').next()
+        with self.prof('to_device'):
+            x, y = self.converter(batch_x, self.args.gpu[0]), self.converter_y(batch_y, self.args.gpu[0])
+        return Variable(x), Variable(y)
+
+    ## loss of the generators, and the inputs to the discriminators: (x, y, x_y_copy, y_x_copy, x_z_copy, y_z_copy)
+    def _loss_gen(self, x, y):
         # encode to latent (X,Y => Z)
-        x_z = self.enc_x(losses.add_noise(x, sigma=self.args.noise))
-        y_z = self.enc_y(losses.add_noise(y, sigma=self.args.noise))
+        x_n = losses.add_noise(x, sigma=self.args.noise)
+        y_n = losses.add_noise(y, sigma=self.args.noise)
+        if self.enc_x is self.enc_y:
+            x_z, y_z = self._passes(self.enc_x, [x_n, y_n], self.batch_gen)
+        else:
+            x_z, y_z = self.enc_x(x_n), self.enc_y(y_n)
+
+        ## decode from latent Z => X,Y
+        x_x, y_x = self._passes(self.dec_x, [x_z, y_z], self.batch_gen)
+        y_y, x_y = self._passes(self.dec_y, [y_z, x_z], self.batch_gen)
+
+        ## translate back: X=>Y=>Z=>X (cycle), X=>Z=>X through enc_y (domain), Y=>X=>Z=>X (idempotence), and symmetrically
+        x_y_x, x_x_dom, y_x_x = self._passes(lambda h: self.dec_x(self.enc_y(h)),
+            [x_y, x if self.args.lambda_domain > 0 else None, y_x if self.args.lambda_idempotence > 0 else None], self.batch_gen)
+        y_x_y, y_y_dom, x_y_y = self._passes(lambda h: self.dec_y(self.enc_x(h)),
+            [y_x, y if self.args.lambda_domain > 0 else None, x_y if self.args.lambda_idempotence > 0 else None], self.batch_gen)
 
         loss_gen = 0
         ## regularisation on the latent space
@@ -50,43 +193,38 @@ class Updater(chainer.training.StandardUpdater):
         ## discriminator for the latent space: distribution of image of enc_x should look same as that of enc_y
         # since z is a list (for u-net), we use only the output of the last layer
         if self.args.lambda_dis_z>0:
+            disz_xz, disz_yz = self._passes(self.dis_z, [x_z[-1], y_z[-1]], self.batch_dis)
             if self.args.dis_wgan:
-                loss_enc_x_adv = -F.average(self.dis_z(x_z[-1]))
-                loss_enc_y_adv = F.average(self.dis_z(y_z[-1]))
+                loss_enc_x_adv = -F.average(disz_xz)
+                loss_enc_y_adv = F.average(disz_yz)
             else:
-                loss_enc_x_adv = losses.loss_func_comp(self.dis_z(x_z[-1]),1.0)
-                loss_enc_y_adv = losses.loss_func_comp(self.dis_z(y_z[-1]),0.0)
+                loss_enc_x_adv = losses.loss_func_comp(disz_xz,1.0)
+                loss_enc_y_adv = losses.loss_func_comp(disz_yz,0.0)
             loss_gen = loss_gen +  self.args.lambda_dis_z * (loss_enc_x_adv+loss_enc_y_adv)
             chainer.report({'loss_adv': loss_enc_x_adv}, self.enc_x)
             chainer.report({'loss_adv': loss_enc_y_adv}, self.enc_y)
 
         # cycle for X=>Z=>X (Autoencoder)
-        x_x = self.dec_x(x_z)
         loss_cycle_xzx = F.mean_absolute_error(x_x, x)
         chainer.report({'loss_cycle': loss_cycle_xzx}, self.enc_x)
         # cycle for Y=>Z=>Y (Autoencoder)
-        y_y = self.dec_y(y_z)
         loss_cycle_yzy = F.mean_absolute_error(y_y, y)
         chainer.report({'loss_cycle': loss_cycle_yzy}, self.enc_y)
         loss_gen = loss_gen + self.args.lambda_Az * loss_cycle_xzx + self.args.lambda_Bz * loss_cycle_yzy
 
-        ## decode from latent Z => Y,X
-        x_y = self.dec_y(x_z)
-        y_x = self.dec_x(y_z)
-
         # cycle for X=>Z=>Y=>Z=>X  (Z=>Y=>Z does not work well)
-        x_y_x = self.dec_x(self.enc_y(x_y))
         loss_cycle_x = F.mean_absolute_error(x_y_x,x)
         chainer.report({'loss_cycle': loss_cycle_x}, self.dec_x)
         # cycle for Y=>Z=>X=>Z=>Y
-        y_x_y = self.dec_y(self.enc_x(y_x))
         loss_cycle_y = F.mean_absolute_error(y_x_y,y)
         chainer.report({'loss_cycle': loss_cycle_y}, self.dec_y)
         loss_gen = loss_gen + self.args.lambda_A * loss_cycle_x + self.args.lambda_B * loss_cycle_y
 
         ## adversarial for Y
+        x_y_copy, y_x_copy, x_z_copy, y_z_copy = None, None, None, None
         if self.args.lambda_dis_y>0:
-            x_y_copy = Variable(self._buffer_y.query(x_y.data))
+            with self.prof('pool'):
+                x_y_copy = Variable(self._buffer_y.query(x_y.data))
             if self.args.dis_wgan:
                 loss_dec_y_adv = -F.average(self.dis_y(x_y))
             else:
@@ -95,7 +233,8 @@ class Updater(chainer.training.StandardUpdater):
             chainer.report({'loss_adv': loss_dec_y_adv}, self.dec_y)
         ## adversarial for X
         if self.args.lambda_dis_x>0:
-            y_x_copy = Variable(self._buffer_x.query(y_x.data))
+            with self.prof('pool'):
+                y_x_copy = Variable(self._buffer_x.query(y_x.data))
             if self.args.dis_wgan:
                 loss_dec_x_adv = -F.average(self.dis_x(y_x))
             else:
@@ -105,15 +244,15 @@ class Updater(chainer.training.StandardUpdater):
 
         ## idempotence
         if self.args.lambda_idempotence > 0:             
-            loss_idem_x = F.mean_absolute_error(y_x,self.dec_x(self.enc_y(y_x)))
-            loss_idem_y = F.mean_absolute_error(x_y,self.dec_y(self.enc_x(x_y)))
+            loss_idem_x = F.mean_absolute_error(y_x,y_x_x)
+            loss_idem_y = F.mean_absolute_error(x_y,x_y_y)
             loss_gen = loss_gen + self.args.lambda_idempotence * (loss_idem_x + loss_idem_y)
             chainer.report({'loss_idem': loss_idem_x}, self.dec_x) 
             chainer.report({'loss_idem': loss_idem_y}, self.dec_y)
         # Y => X shouldn't change X            
         if self.args.lambda_domain > 0:             
-            loss_dom_x = F.mean_absolute_error(x,self.dec_x(self.enc_y(x)))
-            loss_dom_y = F.mean_absolute_error(y,self.dec_y(self.enc_x(y)))
+            loss_dom_x = F.mean_absolute_error(x,x_x_dom)
+            loss_dom_y = F.mean_absolute_error(y,y_y_dom)
             loss_gen = loss_gen + self.args.lambda_domain * (loss_dom_x + loss_dom_y)
             chainer.report({'loss_dom': loss_dom_x}, self.dec_x) 
             chainer.report({'loss_dom': loss_dom_y}, self.dec_y)
@@ -149,123 +288,41 @@ class Updater(chainer.training.StandardUpdater):
             loss_gen = loss_gen + self.args.lambda_tv * loss_tv
             chainer.report({'loss_tv': loss_tv}, self.dec_y)
 
-        ## back propagate 
-        self.enc_x.cleargrads()
-        self.dec_x.cleargrads()
-        self.enc_y.cleargrads()
-        self.dec_y.cleargrads()
-        loss_gen.backward()
-        opt_enc_x.update(loss=loss_gen)
-        opt_dec_x.update(loss=loss_gen)
-        if not self.args.single_encoder:
-            opt_enc_y.update(loss=loss_gen)
-        opt_dec_y.update(loss=loss_gen)
-
-        ##########################################
-        ## discriminator for Y
-        if self.args.dis_wgan: ## synthesised -, real +
-            eps = self.xp.random.uniform(0, 1, size=len(batch_y)).astype(self.xp.float32)[:, None, None, None]
-            if self.args.lambda_dis_y>0:
-                ## discriminator for X=>Y
-                loss_dis_y = F.average(self.dis_y(x_y_copy)-self.dis_y(y))
-                y_mid = eps * y + (1.0 - eps) * x_y_copy
-                # gradient penalty
-                gd_y, = chainer.grad([self.dis_y(y_mid)], [y_mid], enable_double_backprop=True)
-                gd_y = F.sqrt(F.batch_l2_norm_squared(gd_y) + 1e-6)
-                loss_dis_y_gp = F.mean_squared_error(gd_y, self.xp.ones_like(gd_y.data))                
-                chainer.report({'loss_dis': loss_dis_y}, self.dis_y)
-                chainer.report({'loss_gp': self.args.lambda_wgan_gp * loss_dis_y_gp}, self.dis_y)
-                loss_dis_y = loss_dis_y + self.args.lambda_wgan_gp * loss_dis_y_gp
-                self.dis_y.cleargrads()
-                loss_dis_y.backward()
-                opt_y.update(loss=loss_dis_y)
-
-            if self.args.lambda_dis_x>0:
-                ## discriminator for B=>A
-                loss_dis_x = F.average(self.dis_x(y_x_copy)-self.dis_x(x))
-                x_mid = eps * x + (1.0 - eps) * y_x_copy
-                # gradient penalty
-                gd_x, = chainer.grad([self.dis_x(x_mid)], [x_mid], enable_double_backprop=True)
-                gd_x = F.sqrt(F.batch_l2_norm_squared(gd_x) + 1e-6)
-                loss_dis_x_gp = F.mean_squared_error(gd_x, self.xp.ones_like(gd_x.data))
-                chainer.report({'loss_dis': loss_dis_x}, self.dis_x)
-                chainer.report({'loss_gp': self.args.lambda_wgan_gp *loss_dis_x_gp}, self.dis_x)
-                loss_dis_x = loss_dis_x + self.args.lambda_wgan_gp * loss_dis_x_gp
-                self.dis_x.cleargrads()
-                loss_dis_x.backward()
-                opt_x.update(loss=loss_dis_x)
-
-            ## discriminator for latent: X -> Z is - while Y -> Z is +
-            if self.args.lambda_dis_z>0 and t==0:
-                loss_dis_z = F.average(self.dis_z(x_z[-1])-self.dis_z(y_z[-1]))
-                z_mid = eps * x_z[-1] + (1.0 - eps) * y_z[-1]
-                # gradient penalty
-                gd_z, = chainer.grad([self.dis_z(z_mid)], [z_mid], enable_double_backprop=True)
-                gd_z = F.sqrt(F.batch_l2_norm_squared(gd_z) + 1e-6)
-                loss_dis_z_gp = F.mean_squared_error(gd_z, self.xp.ones_like(gd_z.data))                
-                chainer.report({'loss_dis': loss_dis_z}, self.dis_z)
-                chainer.report({'loss_gp': self.args.lambda_wgan_gp * loss_dis_y_gp}, self.dis_y)
-                loss_dis_z = loss_dis_z + self.args.lambda_wgan_gp * loss_dis_z_gp
-                self.dis_z.cleargrads()
-                loss_dis_z.backward()
-                opt_z.update(loss=loss_dis_z)
-
-        else:  ## LSGAN
-            if self.args.lambda_dis_y>0:
-                ## discriminator for A=>B (real:1, fake:0)
-                disy_fake = self.dis_y(x_y_copy)
-                loss_dis_y_fake = losses.loss_func_comp(disy_fake,0.0, self.args.dis_jitter)
-                disy_real = self.dis_y(y)
-                loss_dis_y_real = losses.loss_func_comp(disy_real,1.0, self.args.dis_jitter)
-                if self.args.dis_reg_weighting>0:  ## regularization
-                    loss_dis_y_reg = (F.average(F.absolute(disy_real[:,1,:,:])) + F.average(F.absolute(disy_fake[:,1,:,:])))
-                else:
-                    loss_dis_y_reg = 0
-                chainer.report({'loss_reg': loss_dis_y_reg}, self.dis_y)
-                loss_dis_y_gp = 0
-                chainer.report({'loss_fake': loss_dis_y_fake}, self.dis_y)
-                chainer.report({'loss_real': loss_dis_y_real}, self.dis_y)
-                loss_dis_y = (loss_dis_y_fake + loss_dis_y_real) * 0.5 + self.args.dis_reg_weighting * loss_dis_y_reg + self.args.lambda_wgan_gp * loss_dis_y_gp
-                self.dis_y.cleargrads()
-                loss_dis_y.backward()
-                opt_y.update(loss=loss_dis_y)
+        ## the latent variables are detached from the encoders
+        if self.args.lambda_dis_z>0:
+            x_z_copy, y_z_copy = Variable(x_z[-1].array), Variable(y_z[-1].array)
+        return loss_gen, (x, y, x_y_copy, y_x_copy, x_z_copy, y_z_copy)
 
-            if self.args.lambda_dis_x>0:
-                ## discriminator for B=>A
-                disx_fake = self.dis_x(y_x_copy)
-                loss_dis_x_fake = losses.loss_func_comp(disx_fake,0.0, self.args.dis_jitter)
-                disx_real = self.dis_x(x)
-                loss_dis_x_real = losses.loss_func_comp(disx_real,1.0, self.args.dis_jitter)
-                if self.args.dis_reg_weighting>0: ## regularization
-                    loss_dis_x_reg = (F.average(F.absolute(disx_fake[:,1,:,:]))+ F.average(F.absolute(disx_real[:,1,:,:])))
-                else:
-                    loss_dis_x_reg = 0
-                chainer.report({'loss_reg': loss_dis_x_reg}, self.dis_x)
-                loss_dis_x_gp = 0
-                chainer.report({'loss_fake': loss_dis_x_fake}, self.dis_x)
-                chainer.report({'loss_real': loss_dis_x_real}, self.dis_x)
-                loss_dis_x = (loss_dis_x_fake + loss_dis_x_real) * 0.5 + self.args.dis_reg_weighting * loss_dis_x_reg + self.args.lambda_wgan_gp * loss_dis_x_gp
-                self.dis_x.cleargrads()
-                loss_dis_x.backward()
-                opt_x.update(loss=loss_dis_x)
+    ## LSGAN loss of a discriminator (real:1, fake:0) with the regularisation on the second channel
+    def _loss_dis_lsgan(self, dis, fake, real, names=('loss_fake','loss_real')):
+        dis_fake, dis_real = self._passes(dis, [fake, real], self.batch_dis)
+        loss_fake = losses.loss_func_comp(dis_fake,0.0, self.args.dis_jitter)
+        loss_real = losses.loss_func_comp(dis_real,1.0, self.args.dis_jitter)
+        if self.args.dis_reg_weighting>0:  ## regularization
+            loss_reg = (F.average(F.absolute(dis_fake[:,1,:,:])) + F.average(F.absolute(dis_real[:,1,:,:])))
+        else:
+            loss_reg = 0
+        chainer.report({'loss_reg': loss_reg}, dis)
+        chainer.report({names[0]: loss_fake}, dis)
+        chainer.report({names[1]: loss_real}, dis)
+        return (loss_fake + loss_real) * 0.5 + self.args.dis_reg_weighting * loss_reg
 
-            ## discriminator for latent: X -> Z is 0.0 while Y -> Z is 1.0
-            if self.args.lambda_dis_z>0:
-                disz_xz = self.dis_z(x_z[-1])
-                loss_dis_z_x = losses.loss_func_comp(disz_xz,0.0,self.args.dis_jitter)
-                disz_yz = self.dis_z(y_z[-1])
-                loss_dis_z_y = losses.loss_func_comp(disz_yz,1.0,self.args.dis_jitter)
-                if self.args.dis_reg_weighting>0: ## regularization
-                    loss_dis_z_reg = (F.average(F.absolute(disz_xz[:,1,:,:]))+ F.average(F.absolute(disz_yz[:,1,:,:])))
-                else:
-                    loss_dis_z_reg = 0
-                chainer.report({'loss_x': loss_dis_z_x}, self.dis_z)
-                chainer.report({'loss_y': loss_dis_z_y}, self.dis_z)
-                chainer.report({'loss_reg': loss_dis_z_reg}, self.dis_z)                
-                loss_dis_z = (loss_dis_z_x + loss_dis_z_y) * 0.5 + self.args.dis_reg_weighting * loss_dis_z_reg
-                self.dis_z.cleargrads()
-                loss_dis_z.backward()
-                opt_z.update(loss=loss_dis_z)
+    ## losses of the discriminators (keyed by the optimisers)
+    ## fake and real samples are evaluated in a single pass (the interpolated ones for the gradient penalty are not,
+    ## since otherwise the double backprop would run over the whole batch)
+    def _loss_dis(self, x, y, x_y_copy, y_x_copy, x_z_copy, y_z_copy):
+        loss_dis = {}
+        ## WGAN: synthesised -, real +
+        ## for the latent space, X -> Z is fake while Y -> Z is real
+        for opt, dis, fake, real, weight, names in [('opt_y', self.dis_y, x_y_copy, y, self.args.lambda_dis_y, ('loss_fake','loss_real')),
+                                                    ('opt_x', self.dis_x, y_x_copy, x, self.args.lambda_dis_x, ('loss_fake','loss_real')),
+                                                    ('opt_z', self.dis_z, x_z_copy, y_z_copy, self.args.lambda_dis_z, ('loss_x','loss_y'))]:
+            if weight>0:
+                with self.prof('dis_forward/'+opt):
+                    if self.args.dis_wgan:
+                        loss_dis[opt] = self._loss_dis_wgan(dis, fake, real)
+                    else:
+                        loss_dis[opt] = self._loss_dis_lsgan(dis, fake, real, names)
 
         # prepare next images
         # if(t<self.args.n_critics-1):
@@ -275,4 +332,4 @@ class Updater(chainer.training.StandardUpdater):
         #     batch_y = self.get_iterator('train_B').next()
         #     x = Variable(self.converter(batch_x, self.device))
         #     y = Variable(self.converter(batch_y, self.device))
-
+        return loss_dis
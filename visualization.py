@@ -11,7 +11,7 @@ import warnings
 
 # assume [0,1] input
 def postprocess(var):
-    img = var.data.get()
+    img = cuda.to_cpu(var.data)
     img = (img + 1.0) / 2.0  # [0, 1)
     img = img.transpose(0, 2, 3, 1)
     return img